@@ -0,0 +1,213 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import numpy as np
+
+
+def context_key(history):
+    """
+    This function creates the key of the chat history an answer was generated with. An answer is only reused for a
+    question asked with the same (or likewise empty) chat history, since follow-up questions depend on it.
+    :param history: The formatted chat history, or None if there is none.
+    :return: A hex string, or an empty string if there is no chat history.
+    """
+    if not history:
+        return ""
+    return hashlib.sha256(history.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheEntry:
+    """
+    A cached answer: the embedding of the question it answered, the answer, and the Polly audio of the answer.
+    """
+    vector: np.ndarray
+    question: str
+    answer: str
+    context: str = ""
+    audio: bytes = None
+    key: str = field(default_factory=lambda: uuid.uuid4().hex)
+    created: float = field(default_factory=time.time)
+
+    @property
+    def size(self):
+        """
+        :return: The approximate memory used by the entry, in bytes.
+        """
+        return self.vector.nbytes + len(self.question.encode("utf-8")) + len(self.answer.encode("utf-8")) + \
+            len(self.audio or b"")
+
+
+class SQLiteAnswerStore:
+    """
+    Optional on-disk backend for the answer cache, so cached answers and their audio survive restarts.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, vector BLOB, question TEXT, "
+                                "answer TEXT, context TEXT, audio BLOB, created REAL)")
+        self.connection.commit()
+
+    def load(self):
+        """
+        :return: A list of all stored entries, oldest first.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT key, vector, question, answer, context, audio, created FROM answers "
+                                           "ORDER BY created").fetchall()
+        return [CacheEntry(np.frombuffer(vector, dtype=np.float32), question, answer, context, audio, key, created)
+                for key, vector, question, answer, context, audio, created in rows]
+
+    def save(self, entry):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (entry.key, entry.vector.tobytes(), entry.question, entry.answer, entry.context,
+                                     entry.audio, entry.created))
+            self.connection.commit()
+
+    def delete(self, keys):
+        with self.lock:
+            self.connection.executemany("DELETE FROM answers WHERE key = ?", [(key,) for key in keys])
+            self.connection.commit()
+
+
+class SemanticAnswerCache:
+    """
+    A cache of answers keyed on the embedding of the question. A new question gets a cached answer if its cosine
+    similarity with a cached question passes the threshold and both were asked with the same chat history. Entries are
+    evicted least recently used first, once they are older than the ttl, or when the cache grows past its limits.
+    """
+
+    def __init__(self, threshold=0.95, ttl_seconds=86400, max_entries=1000, max_bytes=64 * 1024 * 1024, store=None):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.store = store
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        # the question embeddings of all entries as one matrix, rebuilt lazily after the entries changed
+        self.matrix = None
+        if store is not None:
+            for entry in store.load():
+                self._insert(entry)
+            self._evict()
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _insert(self, entry):
+        self.entries[entry.key] = entry
+        self.bytes += entry.size
+        self.matrix = None
+
+    def _remove(self, keys):
+        for key in keys:
+            self.bytes -= self.entries.pop(key).size
+            self.evictions += 1
+        if keys:
+            self.matrix = None
+            if self.store is not None:
+                self.store.delete(keys)
+
+    def _evict(self):
+        # dropping expired entries, then the least recently used ones until the cache is within its limits
+        now = time.time()
+        expired = [key for key, entry in self.entries.items() if now - entry.created > self.ttl_seconds]
+        self._remove(expired)
+        overflow = []
+        entries = iter(self.entries.items())
+        count, size = len(self.entries), self.bytes
+        while count > self.max_entries or size > self.max_bytes:
+            key, entry = next(entries)
+            overflow.append(key)
+            count, size = count - 1, size - entry.size
+        self._remove(overflow)
+
+    def lookup(self, vector, context=""):
+        """
+        This function looks up a cached answer for a question.
+        :param vector: The embedding of the question.
+        :param context: The context_key of the chat history the question is asked with.
+        :return: The most similar compatible CacheEntry above the threshold, or None.
+        """
+        query = self._normalize(vector)
+        with self.lock:
+            self._evict()
+            if self.entries:
+                if self.matrix is None:
+                    self.keys = list(self.entries)
+                    self.matrix = np.stack([self.entries[key].vector for key in self.keys])
+                scores = self.matrix @ query
+                # only entries asked with the same chat history are candidates
+                for row in np.argsort(-scores):
+                    if scores[row] < self.threshold:
+                        break
+                    entry = self.entries[self.keys[row]]
+                    if entry.context == context:
+                        self.entries.move_to_end(entry.key)
+                        self.hits += 1
+                        return entry
+            self.misses += 1
+            return None
+
+    def put(self, vector, question, answer, context="", audio=None):
+        """
+        This function caches the answer to a question.
+        :param vector: The embedding of the question.
+        :param question: The question of the user.
+        :param answer: The answer of the LLM.
+        :param context: The context_key of the chat history the question was asked with.
+        :param audio: The Polly mp3 audio of the answer, if it is already available.
+        :return: The new CacheEntry.
+        """
+        entry = CacheEntry(self._normalize(vector), question, answer, context, audio)
+        with self.lock:
+            self._insert(entry)
+            self._evict()
+        if self.store is not None and entry.key in self.entries:
+            self.store.save(entry)
+        return entry
+
+    def attach_audio(self, entry, audio):
+        """
+        This function adds the Polly audio to a cached answer, so a later hit skips Polly as well.
+        :param entry: The CacheEntry of the answer.
+        :param audio: The mp3 audio of the answer.
+        """
+        with self.lock:
+            if entry.key not in self.entries:
+                return
+            self.bytes += len(audio) - len(entry.audio or b"")
+            entry.audio = audio
+            self._evict()
+        if self.store is not None and entry.key in self.entries:
+            self.store.save(entry)
+
+    def metrics(self):
+        """
+        :return: A dictionary with the hits, misses, hit rate, evictions, number of entries and size in bytes.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+            }
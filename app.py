@@ -1,31 +1,50 @@
 import streamlit as st
+import logging
 import os
-from prompt_finder_and_invoke_llm import prompt_finder
-from chat_history_prompt_generator import chat_history
-from live_transcription import main
-from dotenv import load_dotenv
-import boto3
-import botocore.config
-
-# loading in environment variables
-load_dotenv()
-
-# configuring our CLI profile name
-boto3.setup_default_session(profile_name=os.getenv('profile_name'))
-# increasing the timeout period when invoking bedrock
-config = botocore.config.Config(connect_timeout=120, read_timeout=120)
-# instantiating the Polly client
-polly = boto3.client('polly', region_name='us-east-1')
-# instantiating the Transcribe client
-transcribe = boto3.client('transcribe', region_name='us-east-1')
+import time
+import uuid
+from prompt_finder_and_invoke_llm import embed_question, history_summarizer, prompt_finder, prompt_finder_stream
+from text_to_speech import SentenceSplitter, SpeechQueue, synthesize_answer
+from chat_history_prompt_generator import chat_history, conversation_memory
+from answer_cache import context_key
+from live_transcription import TranscriptionSession
+from pipeline import Overloaded
+from speculative_retrieval import SpeculativeRetriever
+from tracing import tracer
+import resources
+
+# the token breakdown of every prompt and the speculative retrieval are logged at the info level, log_level in the .env
+# file sets which messages of the app are shown in the console
+logging.basicConfig(level=os.getenv('log_level', 'INFO').upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
 # Title displayed on the streamlit web app
 st.title(f""":rainbow[Bedrock Speech-to-Text Chat]""")
 
-# configuring values for session state
+# preloading the embedding model, example index and AWS clients once per process in a background thread, so the page is
+# rendered right away, every later session and rerun reuses the warm resources from the registry in resources.py
+resources.warm_in_background()
+# a resource that failed to load is shown in the status of the sidebar, and no question can be asked until it loads
+if resources.failures() and not resources.is_warming():
+    st.error(f"Some resources failed to load: {', '.join(resources.failures())}. Reload the page to try again.")
+elif not resources.is_ready():
+    st.info(":hourglass: Warming up the models, you can start a conversation in a moment...")
+
+# the shared stages every question goes through, they bound the concurrent embedding, Bedrock and Polly calls of all
+# sessions of this process
+pipeline = resources.get_pipeline()
+# the id of this conversation, it is kept in the url (?session=...) so reloading the page continues the same conversation
+# from the chat history database, and it limits the number of questions of one user that are answered at the same time
+if "session_id" not in st.session_state:
+    st.session_state.session_id = st.query_params.get("session") or str(uuid.uuid4())
+    st.query_params["session"] = st.session_state.session_id
+
+# the conversation memory of this session, older questions/answers are summarized in the background
+memory = conversation_memory(st.session_state, st.session_state.session_id, history_summarizer)
+# configuring values for session state, showing the questions and answers restored from the chat history database
 if "messages" not in st.session_state:
-    st.session_state.messages = []
-    open("chat_history.txt", "w").close()
+    st.session_state.messages = [message for turn in memory for message in
+                                 ({"role": "user", "content": turn.question},
+                                  {"role": "assistant", "content": turn.answer})]
 # writing the message that is stored in session state
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
@@ -33,6 +52,19 @@ for message in st.session_state.messages:
 
 # creating empty transcript string for streamed input to be added to
 transcript = ""
+# retrieves the sample prompts from the partial transcripts while the user is still speaking
+speculator = None
+# the root span of the current turn, every stage from listening to playback is recorded as a child of it
+turn_span = None
+
+
+# closing the trace of the turn, also if no question was heard or answering it failed
+def end_turn():
+    global turn_span
+    if turn_span is not None:
+        turn_span.set(question_characters=len(transcript.strip()))
+        tracer.end_span(turn_span)
+        turn_span = None
 response_placeholder = st.empty()
 
 
@@ -43,11 +75,59 @@ def play_audio(audio_data):
 
 # add language selection and transcription button to sidebar
 with st.sidebar:
-    # call main function from live_transcription.py and start audio transcription job
+    # streaming shows the answer while it is generated and starts reading it out loud after the first sentence
+    streaming = st.toggle("Stream responses", value=os.getenv('streaming_responses', 'true') == 'true')
+    # speculative retrieval searches the sample prompts while the question is still being spoken
+    speculative = st.toggle("Speculative retrieval", value=os.getenv('speculative_retrieval', 'true') == 'true')
+    # showing the readiness of the warm resources, and the cold start and steady state time-to-first-answer
+    with st.expander("Status"):
+        errors = resources.failures()
+        for name, state in resources.readiness().items():
+            st.write(f"{name}: {state}" + (f" ({errors[name]})" if name in errors else ""))
+        timings = resources.timings()
+        if timings["warm_up_seconds"] is not None:
+            st.write(f"Warm up: {timings['warm_up_seconds']:.2f}s")
+        if timings["cold_start_answer_seconds"] is not None:
+            st.write(f"Cold start time-to-first-answer: {timings['cold_start_answer_seconds']:.2f}s")
+        if timings["steady_state_answer_seconds"] is not None:
+            st.write(f"Steady state time-to-first-answer (median of {timings['steady_state_answers']}): "
+                     f"{timings['steady_state_answer_seconds']:.2f}s")
+        if resources.readiness()["answer_cache"] == "ready":
+            cache_metrics = resources.get_answer_cache().metrics()
+            st.write(f"Answer cache: {cache_metrics['hits']} hits, {cache_metrics['misses']} misses, "
+                     f"{cache_metrics['entries']} entries ({cache_metrics['bytes'] / 1024:.0f} KB)")
+        # the query cache of the ONNX embedding backend, a question is often embedded more than once
+        if resources.readiness()["embeddings"] == "ready" and hasattr(resources.get_embeddings(), "cache_stats"):
+            embedding_cache = resources.get_embeddings().cache_stats()
+            lookups = embedding_cache["hits"] + embedding_cache["misses"]
+            st.write(f"Embedding cache: {embedding_cache['hits']} hits, {embedding_cache['misses']} misses "
+                     f"({embedding_cache['hits'] / lookups if lookups else 0:.0%} hit rate), "
+                     f"{embedding_cache['size']} entries")
+        for name, stage in pipeline.metrics().items():
+            st.write(f"{name} stage: {stage['in_flight']} in flight of {stage['capacity']}, "
+                     f"{stage['rejected']} rejected")
+    # showing the p50/p95 latency of every stage of the recent turns of all sessions
+    if st.toggle("Latency debug", value=os.getenv('debug_sidebar', 'false') == 'true'):
+        st.table([{"stage": name, "count": stats["count"], "p50 (ms)": round(stats["p50"] * 1000, 1),
+                   "p95 (ms)": round(stats["p95"] * 1000, 1)} for name, stats in tracer.percentiles().items()])
+
+    # call the transcription session from live_transcription.py and transcribe the next question
     def processing():
         with st.spinner(':ear: Bedrock is listening...'):
-            global transcript
-            transcript = main("en-US")
+            global transcript, speculator, turn_span
+            turn_span = tracer.start_span("turn", session_id=st.session_state.session_id)
+            try:
+                # opening one long-lived transcription session per user when the first question is asked, it keeps
+                # the microphone and the Transcribe stream warm between questions, all sessions share one event loop,
+                # and it releases both when the user is idle or the streamlit session ends
+                if "transcription" not in st.session_state:
+                    st.session_state.transcription = TranscriptionSession("en-US", loop=resources.get_event_loop())
+                speculator = SpeculativeRetriever(memory) if speculative else None
+                transcript = st.session_state.transcription.listen(speculator.update if speculator else None)
+            except BaseException:
+                # the turn is also closed if listening failed or streamlit stopped the script
+                end_turn()
+                raise
         return "Transcription ended!"
 
 
@@ -73,7 +153,8 @@ with st.sidebar:
     upper = st.container()
     upper.write(
         ':studio_microphone: Click to start a conversation session. After 3 seconds of silence, your question will be sent to Bedrock.')
-    st.button('Start Conversation', type="primary", on_click=run, disabled=st.session_state.run)
+    st.button('Start Conversation', type="primary", on_click=run,
+              disabled=st.session_state.run or not resources.is_ready())
     result_area = st.empty()
     # if button is clicked, call processing() and put button in disabled state
     if st.session_state.run:
@@ -87,33 +168,115 @@ with st.sidebar:
         result_container.button('Ask New Question', on_click=clear)
 # evaluating if transcript string is finalized and determining if question has been input
 if transcript:
-    # with the user icon, write the question to the front end
-    with st.chat_message("user"):
-        st.markdown(transcript)
-        # adding some special effects from the UI perspective
-        st.balloons()
-    # append the question and the role (user) as a message to the session state
-    st.session_state.messages.append({"role": "user",
-                                      "content": transcript})
-    # respond as the assistant with the answer
-    with st.chat_message("assistant"):
-        # making sure there are no messages present when generating the answer
-        message_placeholder = st.empty()
-        # putting a spinning icon to show that the query is in progress
-        with st.spinner("Determining the best possible answer!") as status:
-            # passing the question into the kendra search function, which later invokes the llm
-            answer = prompt_finder(transcript)
-            # writing the answer to the front end
-            message_placeholder.markdown(f"{answer}")
-    # appending the results to the session state
-    st.session_state.messages.append({"role": "assistant", "content": answer})
-    # invoke Polly by passing in transcript and returning audio response
-    response = polly.synthesize_speech(Text=answer, OutputFormat='mp3', VoiceId='Danielle', Engine="neural")
-    response_audio = response['AudioStream'].read()
-    # create an empty placeholder for the audio player
-    response_placeholder = st.empty()
-    # display audio player
-    response_placeholder.audio(response_audio, format='audio/mp3', start_time=0, autoplay=True)
-    # invoking that chat_history function in the chat_history_prompt_generator.py file to format past questions and
-    # answers and dynamically add them to future prompt
-    chat_history(st.session_state)
\ No newline at end of file
+    # the streamed answer whose remaining sentences are still to be played
+    playback = None
+    try:
+        # only one question per session is answered at a time, and the shared stages push back when they are full
+        with pipeline.users.slot(st.session_state.session_id):
+            # starting the time-to-first-answer clock as soon as the question is finalized
+            question_time = time.perf_counter()
+            # with the user icon, write the question to the front end
+            with st.chat_message("user"):
+                st.markdown(transcript)
+                # adding some special effects from the UI perspective
+                st.balloons()
+            # respond as the assistant with the answer
+            with st.chat_message("assistant"):
+                # making sure there are no messages present when generating the answer
+                message_placeholder = st.empty()
+                # create an empty placeholder for the audio player
+                response_placeholder = st.empty()
+                # the question is embedded once, for the answer cache and for the semantic search of the sample prompts,
+                # with speculative retrieval most of that already happened while the user was speaking
+                prompt = None
+                if speculator is not None:
+                    speculation = speculator.finalize(transcript)
+                    query_vector, prompt = speculation.vector, speculation.prompt
+                else:
+                    query_vector = pipeline.run("embedding", embed_question, transcript)
+                context = context_key(memory.format_history())
+                cached = resources.get_answer_cache().lookup(query_vector, context)
+                if cached is not None:
+                    # a near-duplicate question was answered before with the same chat history, Bedrock and Polly
+                    # are skipped
+                    answer = cached.answer
+                    message_placeholder.markdown(f"{answer}")
+                    resources.record_answer_time(time.perf_counter() - question_time)
+                    # the entry may be evicted by another session before the audio is attached, so the synthesized
+                    # audio is played rather than read back from the entry
+                    audio = cached.audio
+                    if audio is None:
+                        audio = synthesize_answer(answer)
+                        resources.get_answer_cache().attach_audio(cached, audio)
+                    response_placeholder.audio(audio, format='audio/mp3', start_time=0, autoplay=True)
+                    tracer.record("playback_start", question_time, audio_bytes=len(audio), cached=True)
+                    st.caption("Answered from the cache")
+                elif streaming:
+                    # passing the question into the prompt finder, the answer is streamed back from the llm piece by
+                    # piece
+                    answer = ""
+                    first_token_time = None
+                    splitter = SentenceSplitter()
+                    # every completed sentence is sent to Polly while the rest of the answer is still being generated
+                    speech = SpeechQueue(lambda audio: response_placeholder.audio(audio, format='audio/mp3',
+                                                                                  start_time=0, autoplay=True))
+                    for token in pipeline.stream("llm", prompt_finder_stream, transcript, memory, query_vector,
+                                                 prompt):
+                        if first_token_time is None:
+                            first_token_time = time.perf_counter()
+                            resources.record_answer_time(first_token_time - question_time)
+                        answer += token
+                        # writing the answer to the front end as it comes in
+                        message_placeholder.markdown(f"{answer}▌")
+                        for sentence in splitter.feed(token):
+                            speech.add(sentence)
+                        # playing the audio of the first sentences as soon as it is ready
+                        speech.play_ready()
+                    message_placeholder.markdown(f"{answer}")
+                    for sentence in splitter.flush():
+                        speech.add(sentence)
+                    # caching the answer and its audio for near-duplicate questions, the remaining sentences are
+                    # played once the answer is stored
+                    resources.get_answer_cache().put(query_vector, transcript, answer, context, speech.finish())
+                    playback = speech
+                else:
+                    # putting a spinning icon to show that the query is in progress
+                    with st.spinner("Determining the best possible answer!") as status:
+                        # passing the question into the kendra search function, which later invokes the llm
+                        answer = pipeline.run("llm", prompt_finder, transcript, memory, query_vector, prompt)
+                        # writing the answer to the front end
+                        message_placeholder.markdown(f"{answer}")
+                        resources.record_answer_time(time.perf_counter() - question_time)
+                    # invoke Polly by passing in the answer and display the audio player
+                    response_audio = synthesize_answer(answer)
+                    response_placeholder.audio(response_audio, format='audio/mp3', start_time=0, autoplay=True)
+                    tracer.record("playback_start", question_time, audio_bytes=len(response_audio))
+                    # caching the answer and its audio for near-duplicate questions
+                    resources.get_answer_cache().put(query_vector, transcript, answer, context, response_audio)
+            # appending the question and the results to the session state once the answer is there, so a question that
+            # was rejected as overloaded does not stay in the chat without an answer
+            st.session_state.messages.append({"role": "user", "content": transcript})
+            st.session_state.messages.append({"role": "assistant", "content": answer})
+            # invoking that chat_history function in the chat_history_prompt_generator.py file to add the question and
+            # answer to the conversation memory of this session, which is injected into future prompts
+            chat_history(st.session_state)
+        if playback is not None:
+            # playing the remaining sentences after the segment that is playing now, outside of the user slot
+            playback.drain()
+            if playback.first_audio_time is not None:
+                tracer.record("playback_start", question_time, playback.first_audio_time)
+            # reporting the time-to-first-token and time-to-first-audio of the streamed answer
+            if first_token_time is not None and playback.first_audio_time is not None:
+                st.caption(f"Time to first token: {first_token_time - question_time:.2f}s · "
+                           f"Time to first audio: {playback.first_audio_time - question_time:.2f}s")
+    except Overloaded as e:
+        st.warning(f"Too many questions are being answered right now, please ask again in a moment. ({e})")
+    finally:
+        end_turn()
+else:
+    end_turn()
+
+# refreshing the page until the background warm up has finished, so the status and the question button are updated
+if resources.is_warming():
+    time.sleep(1)
+    st.rerun()
@@ -0,0 +1,146 @@
+import threading
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def design_lowpass(factor, taps_per_phase=16):
+    """
+    This function designs the anti-aliasing filter used before decimation, a Hamming windowed sinc low-pass filter.
+    :param factor: The decimation factor, for example 3 to go from 48 kHz to 16 kHz.
+    :param taps_per_phase: The number of filter taps per output phase, more taps give a steeper filter.
+    :return: The filter taps as a float32 array.
+    """
+    taps = 2 * taps_per_phase * factor + 1
+    # cutting off a little below the new Nyquist frequency, so the transition band does not alias
+    cutoff = 0.45 / factor
+    n = np.arange(taps) - (taps - 1) / 2
+    h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (h / h.sum()).astype(np.float32)
+
+
+class Decimator:
+    """
+    A streaming polyphase decimator for int16 audio. Only the output samples that are kept are computed, and the filter
+    state is carried over between blocks, so blocks can be resampled one by one without clicks at the block edges.
+    """
+
+    def __init__(self, in_rate, out_rate, taps_per_phase=16):
+        if in_rate % out_rate:
+            raise ValueError(f"The capture rate {in_rate} must be a multiple of the transcription rate {out_rate}")
+        self.factor = in_rate // out_rate
+        self.taps = design_lowpass(self.factor, taps_per_phase)[::-1].copy()
+        self.reset()
+
+    def reset(self):
+        """
+        This function clears the filter state, for example before a new question.
+        """
+        self.history = np.zeros(len(self.taps) - 1, dtype=np.float32)
+        self.offset = 0
+
+    def process(self, samples):
+        """
+        This function resamples the next block of audio.
+        :param samples: The int16 samples at the capture rate.
+        :return: The int16 samples at the transcription rate.
+        """
+        if self.factor == 1:
+            return samples
+        signal = np.concatenate((self.history, samples.astype(np.float32)))
+        # every row of the sliding window view is the filter input of one kept output sample
+        windows = sliding_window_view(signal, len(self.taps))[self.offset::self.factor]
+        output = windows @ self.taps
+        # remembering where the next kept output sample starts in the next block
+        self.offset = self.offset + len(output) * self.factor - (len(signal) - len(self.taps) + 1)
+        self.history = signal[len(signal) - len(self.taps) + 1:]
+        return np.clip(np.round(output), -32768, 32767).astype(np.int16)
+
+
+class RingBuffer:
+    """
+    A preallocated int16 ring buffer between the audio callback thread and the transcription event loop. If the reader
+    falls behind by more than the capacity, the oldest audio is overwritten.
+    """
+
+    def __init__(self, capacity):
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.read_position = 0
+            self.write_position = 0
+
+    def available(self):
+        return self.write_position - self.read_position
+
+    def write(self, samples):
+        """
+        This function copies samples into the ring buffer, wrapping around at the end.
+        :param samples: The int16 samples to store.
+        """
+        with self.lock:
+            samples = samples[-self.capacity:]
+            start = self.write_position % self.capacity
+            first = min(len(samples), self.capacity - start)
+            self.buffer[start:start + first] = samples[:first]
+            self.buffer[:len(samples) - first] = samples[first:]
+            self.write_position += len(samples)
+            # dropping the oldest samples if the reader fell behind
+            self.read_position = max(self.read_position, self.write_position - self.capacity)
+
+    def read(self, count):
+        """
+        This function takes the oldest samples out of the ring buffer.
+        :param count: The maximum number of samples to read.
+        :return: The samples as bytes, ready to be sent to Transcribe.
+        """
+        with self.lock:
+            count = min(count, self.available())
+            start = self.read_position % self.capacity
+            first = min(count, self.capacity - start)
+            if first == count:
+                chunk = self.buffer[start:start + count].tobytes()
+            else:
+                chunk = self.buffer[start:].tobytes() + self.buffer[:count - first].tobytes()
+            self.read_position += count
+            return chunk
+
+
+class CapturePipeline:
+    """
+    Turns the raw microphone blocks into transcription sized chunks: every block is resampled to the transcription rate,
+    packed into a preallocated ring buffer, and handed out once a full chunk is available.
+    """
+
+    def __init__(self, capture_rate, transcribe_rate, chunk_ms=100, buffer_seconds=10):
+        self.capture_rate = capture_rate
+        self.transcribe_rate = transcribe_rate
+        self.decimator = Decimator(capture_rate, transcribe_rate)
+        self.chunk_samples = transcribe_rate * chunk_ms // 1000
+        self.ring = RingBuffer(transcribe_rate * buffer_seconds)
+
+    def reset(self):
+        self.decimator.reset()
+        self.ring.reset()
+
+    def push(self, indata):
+        """
+        This function is called from the audio callback with the raw block, which is read in place without copying it.
+        :param indata: The raw int16 block from the microphone.
+        :return: The number of complete chunks that are ready to be read.
+        """
+        self.ring.write(self.decimator.process(np.frombuffer(indata, dtype=np.int16)))
+        return self.ring.available() // self.chunk_samples
+
+    def pop(self, flush=False):
+        """
+        This function reads the next transcription sized chunk.
+        :param flush: If True, a last incomplete chunk is returned as well.
+        :return: The chunk as bytes, or None if no (complete) chunk is available.
+        """
+        if self.ring.available() >= self.chunk_samples or (flush and self.ring.available()):
+            return self.ring.read(self.chunk_samples)
+        return None
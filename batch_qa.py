@@ -0,0 +1,346 @@
+"""
+Batch question answering, for evaluation and for generating answers ahead of time. The questions go through the same
+retrieval and few-shot prompt as prompt_finder(), but a whole batch of questions is embedded in one call and the
+examples of the batch are selected with one vectorized top-k search.
+
+    python batch_qa.py questions.jsonl [more.jsonl ...] --output answers.jsonl
+    python batch_qa.py recordings/*.wav --output answers.jsonl
+
+JSONL input has one question per line, in the "question" field (see --field) and with an optional "id". Audio input is
+16 bit wav files with one question each, transcribed with Amazon Transcribe first. The answers are appended to the output
+file as soon as they are ready, one JSON object per line. The output file is also the checkpoint: running the same
+command again skips every question that already has an answer, so an interrupted run resumes where it stopped.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import numpy as np
+import botocore.exceptions
+from prompt_finder_and_invoke_llm import build_prompt, llm_answer_generator
+from resources import get_embeddings, get_example_selector
+from tracing import tracer
+
+# the number of questions that are embedded and searched together
+BATCH_SIZE = 256
+# the Bedrock calls that run at the same time
+CONCURRENCY = 8
+# the maximum number of Bedrock calls started per second, 0 for no limit
+REQUESTS_PER_SECOND = 5.0
+# the attempts per question before it is written to the output as failed
+MAX_ATTEMPTS = 5
+# the first retry waits this long in seconds, every further retry twice as long
+RETRY_BASE_DELAY = 1.0
+# the Bedrock errors that are worth retrying, everything else (like a malformed request) fails the question right away
+RETRYABLE_ERRORS = {"ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException",
+                    "InternalServerException", "ModelTimeoutException", "ModelNotReadyException"}
+# the audio files that are sent to Amazon Transcribe at the same time
+TRANSCRIBE_CONCURRENCY = 4
+
+
+class RateLimiter:
+    """
+    Spaces out calls evenly, so no more than `rate` calls are started per second across all threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        This function blocks until the caller may start its call.
+        """
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        time.sleep(start - now)
+
+
+def is_retryable(error):
+    """
+    This function decides if a failed Bedrock call is worth retrying.
+    :param error: The exception raised by the call.
+    :return: True for throttling, timeouts and temporary service errors.
+    """
+    if isinstance(error, botocore.exceptions.ClientError):
+        return error.response.get("Error", {}).get("Code") in RETRYABLE_ERRORS
+    return isinstance(error, (botocore.exceptions.ConnectionError, botocore.exceptions.ReadTimeoutError))
+
+
+def invoke_with_retries(prompt, limiter, max_attempts=MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY):
+    """
+    This function invokes Amazon Bedrock with the rate limit, retrying temporary errors with exponential backoff.
+    :param prompt: The few-shot prompt of the question.
+    :param limiter: The RateLimiter shared by all calls of the batch.
+    :param max_attempts: The maximum number of calls.
+    :param base_delay: The wait before the first retry, in seconds.
+    :return: A tuple of the answer and the number of attempts it took.
+    """
+    for attempt in range(1, max_attempts + 1):
+        limiter.wait()
+        try:
+            return llm_answer_generator(prompt), attempt
+        except Exception as e:
+            if attempt == max_attempts or not is_retryable(e):
+                raise
+            # full jitter, so throttled workers do not retry in lockstep
+            time.sleep(random.uniform(0, base_delay * 2 ** (attempt - 1)))
+
+
+def read_jsonl(path, field="question"):
+    """
+    This function reads the questions of a JSONL file lazily, line by line.
+    :param path: The path of the JSONL file.
+    :param field: The field that holds the question.
+    :return: A generator of (id, question, error) tuples, the id defaults to the file name and line number. The error is
+    None, or the reason a line has no usable question, so a single malformed line does not abort the batch.
+    """
+    with open(path, "r") as questions:
+        for line_number, line in enumerate(questions, 1):
+            if not line.strip():
+                continue
+            question_id = f"{path}:{line_number}"
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield question_id, None, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(record, dict):
+                yield question_id, None, "The line is not a JSON object"
+                continue
+            question_id = str(record.get("id", question_id))
+            question = record.get(field)
+            if not isinstance(question, str):
+                yield question_id, question, f"The {field} field is missing or not a string"
+                continue
+            yield question_id, question, None
+
+
+def transcribe_files(paths, concurrency=TRANSCRIBE_CONCURRENCY, language_code="en-US", region="us-east-1", speed=1.0):
+    """
+    This function transcribes recorded questions with Amazon Transcribe, several files at a time. Every file is resampled
+    by the same capture pipeline as the microphone audio.
+    :param paths: The paths of the 16 bit wav files.
+    :param concurrency: The number of files transcribed at the same time.
+    :param language_code: The language of the recordings.
+    :param region: The AWS region of Amazon Transcribe.
+    :param speed: How much faster than real time the audio is sent, 0 to send it as fast as possible.
+    :return: A list of (id, transcript) tuples, the id is the path of the file.
+    """
+    # the transcription modules are only needed for audio input
+    from amazon_transcribe.client import TranscribeStreamingClient
+    from amazon_transcribe.handlers import TranscriptResultStreamHandler
+    from live_transcription import CHUNK_MS, SAMPLE_RATE
+    from local_stubs import capture_chunks, read_wav
+
+    class TranscriptCollector(TranscriptResultStreamHandler):
+        def __init__(self, transcript_result_stream):
+            super().__init__(transcript_result_stream)
+            self.transcript = ""
+
+        async def handle_transcript_event(self, transcript_event):
+            # only the finalized results make up the transcript of a recording
+            for result in transcript_event.transcript.results:
+                if not result.is_partial and result.alternatives:
+                    self.transcript += " " + result.alternatives[0].transcript
+
+    async def transcribe(client, path, semaphore):
+        samples, rate = read_wav(path)
+        chunks = capture_chunks(samples, rate, SAMPLE_RATE, chunk_ms=CHUNK_MS)
+        async with semaphore:
+            with tracer.span("batch_transcription", audio_bytes=sum(len(chunk) for chunk in chunks)):
+                stream = await client.start_stream_transcription(language_code=language_code,
+                                                                 media_sample_rate_hz=SAMPLE_RATE,
+                                                                 media_encoding="pcm")
+                handler = TranscriptCollector(stream.output_stream)
+
+                async def write():
+                    for chunk in chunks:
+                        await stream.input_stream.send_audio_event(audio_chunk=chunk)
+                        if speed > 0:
+                            await asyncio.sleep(CHUNK_MS / 1000 / speed)
+                    await stream.input_stream.end_stream()
+                # the whole recording is one question, so the transcript is complete once Transcribe closes the stream
+                await asyncio.gather(write(), handler.handle_events())
+        print(f"Transcribed {path}: {handler.transcript.strip()}")
+        return path, handler.transcript.strip()
+
+    async def run():
+        client = TranscribeStreamingClient(region=region)
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*(transcribe(client, path, semaphore) for path in paths))
+    return asyncio.run(run())
+
+
+def load_checkpoint(output_path):
+    """
+    This function reads the answers a previous run already wrote to the output file.
+    :param output_path: The path of the output JSONL file.
+    :return: The set of ids that have an answer, failed questions are not included so they are tried again.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r") as answers:
+        for line in answers:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of a run that was killed while writing
+                continue
+            if "answer" in record:
+                done.add(record["id"])
+    return done
+
+
+def batched(items, size):
+    """
+    This function groups an iterable into lists of at most `size` items, without reading it all into memory.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def retrieve_batch(questions):
+    """
+    This function embeds a batch of questions in one call, selects the examples of all of them with one top-k search,
+    and assembles the few-shot prompt of every question, like prompt_finder() does for a single question.
+    :param questions: A list of questions.
+    :return: A tuple of the list of selected examples and the list of prompts, one per question.
+    """
+    with tracer.span("embedding", questions=len(questions), characters=sum(len(question) for question in questions)):
+        vectors = np.asarray(get_embeddings().embed_documents(list(questions)), dtype=np.float32)
+    examples = get_example_selector().select_examples_batch(vectors)
+    prompts = [build_prompt(question, None, vector, selected)
+               for question, vector, selected in zip(questions, vectors, examples)]
+    return examples, prompts
+
+
+def answer_questions(questions, concurrency=CONCURRENCY, requests_per_second=REQUESTS_PER_SECOND,
+                     batch_size=BATCH_SIZE, max_attempts=MAX_ATTEMPTS, include_prompt=False):
+    """
+    This function answers questions in bulk. The next batch is embedded and searched while the Bedrock calls of the
+    previous one are still running, and the results are handed out in the order they finish.
+    :param questions: An iterable of (id, question) tuples.
+    :param concurrency: The number of Bedrock calls that run at the same time.
+    :param requests_per_second: The maximum number of Bedrock calls started per second, 0 for no limit.
+    :param batch_size: The number of questions that are embedded and searched together.
+    :param max_attempts: The attempts per question before it fails.
+    :param include_prompt: If True, the few-shot prompt is included in the results.
+    :return: A generator of result dictionaries with the id, question, answer (or error), the inputs of the selected
+    examples, the attempts and the seconds the answer took.
+    """
+    limiter = RateLimiter(requests_per_second)
+
+    def answer(question_id, question, examples, prompt):
+        start = time.perf_counter()
+        result = {"id": question_id, "question": question, "examples": [example["input"] for example in examples]}
+        if include_prompt:
+            result["prompt"] = prompt
+        try:
+            result["answer"], result["attempts"] = invoke_with_retries(prompt, limiter, max_attempts)
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        return result
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch-llm")
+    pending = set()
+    try:
+        for batch in batched(questions, batch_size):
+            ids, texts = zip(*batch)
+            examples, prompts = retrieve_batch(texts)
+            for arguments in zip(ids, texts, examples, prompts):
+                pending.add(executor.submit(answer, *arguments))
+                # bounding the calls waiting for a worker, finished answers are handed out while more are submitted
+                while len(pending) >= 2 * concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # dropping the queued calls if the caller stopped early
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer questions from JSONL or wav files in bulk.")
+    parser.add_argument("inputs", nargs="+", help="JSONL files with one question per line, or 16 bit wav recordings")
+    parser.add_argument("--output", required=True, help="the JSONL file the answers are appended to")
+    parser.add_argument("--field", default="question", help="the field of the JSONL records that holds the question")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="Bedrock calls in parallel")
+    parser.add_argument("--rate", type=float, default=REQUESTS_PER_SECOND,
+                        help="maximum Bedrock calls started per second, 0 for no limit")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="questions embedded together")
+    parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS, help="attempts per question")
+    parser.add_argument("--include-prompt", action="store_true", help="write the few-shot prompt of every question")
+    parser.add_argument("--transcribe-concurrency", type=int, default=TRANSCRIBE_CONCURRENCY,
+                        help="wav files transcribed in parallel")
+    parser.add_argument("--transcribe-speed", type=float, default=1.0,
+                        help="how much faster than real time audio is sent to Transcribe, 0 for as fast as possible")
+    args = parser.parse_args()
+
+    done = load_checkpoint(args.output)
+    if done:
+        print(f"Resuming: {len(done)} questions already answered in {args.output}")
+    audio_paths = [path for path in args.inputs if path.lower().endswith(".wav") and path not in done]
+    jsonl_paths = [path for path in args.inputs if not path.lower().endswith(".wav")]
+    transcripts = transcribe_files(audio_paths, args.transcribe_concurrency, speed=args.transcribe_speed) \
+        if audio_paths else []
+
+    def questions():
+        for question_id, transcript in transcripts:
+            yield question_id, transcript, None
+        for path in jsonl_paths:
+            yield from read_jsonl(path, args.field)
+
+    answered = failed = 0
+    start = time.perf_counter()
+    # appending and flushing every answer, so a run that is interrupted loses nothing that was already answered
+    with open(args.output, "a") as output:
+        def write(result):
+            nonlocal answered, failed
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            if "error" in result:
+                failed += 1
+                print(f"Failed {result['id']}: {result['error']}")
+            else:
+                answered += 1
+
+        def remaining():
+            for question_id, question, error in questions():
+                if question_id in done:
+                    continue
+                # a line without a usable question is written as failed, like an answer that failed, and the run goes on
+                if error is not None:
+                    write({"id": question_id, "question": question, "error": error})
+                elif question.strip():
+                    yield question_id, question
+
+        for result in answer_questions(remaining(), args.concurrency, args.rate, args.batch_size, args.max_attempts,
+                                       args.include_prompt):
+            write(result)
+    print(f"{answered} answered, {failed} failed in {time.perf_counter() - start:.1f} s, written to {args.output}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+"""
+Offline benchmark of the question answering pipeline. Amazon Bedrock, Amazon Polly and Amazon Transcribe are replaced by
+the local stand-ins from local_stubs.py, only the embedding model and the example search run for real.
+
+    python benchmark.py [--iterations 50] [--concurrency 4] [--wav recording.wav] [--output results.json]
+    python benchmark.py --save-baseline
+
+Every scenario (prompt_finder, llm_answer_generator, transcription and the full turn) reports its throughput and latency
+percentiles, together with the peak RSS and the cold start time of the process. The results are compared with
+benchmarks/baseline.json, and the exit code is 1 if anything got slower than the baseline by more than the tolerance.
+The embedding model runs on the local CPU, so a baseline is only valid on the host it was saved on, it is not committed
+and has to be saved on every host with --save-baseline before the code is changed.
+"""
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# the stand-ins are selected before any module of the app is imported, and the Polly audio cache starts out empty and
+# is removed when the process exits
+os.environ["llm_backend"] = "stub"
+os.environ["tts_backend"] = "stub"
+_tts_cache_dir = tempfile.TemporaryDirectory(prefix="benchmark_tts_cache_")
+atexit.register(_tts_cache_dir.cleanup)
+os.environ["tts_cache_dir"] = _tts_cache_dir.name
+
+# the stored results the benchmark is compared with, saved per host and not committed
+BASELINE_PATH = "benchmarks/baseline.json"
+# the metrics that may not grow, and the ones that may not shrink, by more than the tolerance
+LOWER_IS_BETTER = ("p50", "p95", "time_to_first_token_p50", "time_to_first_audio_p50")
+HIGHER_IS_BETTER = ("throughput",)
+
+
+def summarize(samples):
+    """
+    This function summarizes a list of latencies.
+    :param samples: The latencies in seconds.
+    :return: A dictionary with the count, mean, p50, p95 and p99.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    return {"count": int(samples.size), "mean": float(samples.mean()),
+            "p50": float(np.percentile(samples, 50)), "p95": float(np.percentile(samples, 95)),
+            "p99": float(np.percentile(samples, 99))}
+
+
+def run_scenario(function, inputs, concurrency):
+    """
+    This function calls a function for every input, with the given number of calls in parallel.
+    :param function: The function to benchmark, it is called with one input.
+    :param inputs: The inputs, one call each.
+    :param concurrency: The number of calls in parallel.
+    :return: A dictionary with the throughput (calls per second), the latency percentiles and the results.
+    """
+    def timed(argument):
+        start = time.perf_counter()
+        result = function(argument)
+        return time.perf_counter() - start, result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        timings = list(executor.map(timed, inputs))
+    wall = time.perf_counter() - start
+    report = summarize([seconds for seconds, _ in timings])
+    report["throughput"] = len(timings) / wall
+    return report, [result for _, result in timings]
+
+
+def peak_rss_mb():
+    """
+    :return: The peak resident set size of this process, in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def cold_start_child():
+    # runs in a fresh interpreter: importing the app modules, warming the resources and answering the first question
+    start = time.perf_counter()
+    import resources
+    from prompt_finder_and_invoke_llm import prompt_finder
+    imported = time.perf_counter()
+    resources.warm()
+    warmed = time.perf_counter()
+    prompt_finder(resources.get_samples()[0]["input"])
+    answered = time.perf_counter()
+    print(json.dumps({"import_seconds": imported - start, "warm_up_seconds": warmed - imported,
+                      "first_answer_seconds": answered - warmed, "total_seconds": answered - start}))
+
+
+def cold_start():
+    """
+    This function measures the cold start in a new process, from starting the interpreter to the first answer.
+    :return: A dictionary with the import, warm up, first answer and total seconds.
+    """
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--cold-start-child"], capture_output=True,
+                            text=True, check=True).stdout
+    report = json.loads(output.strip().splitlines()[-1])
+    report["process_seconds"] = time.perf_counter() - start
+    return report
+
+
+def transcription_chunks(wav):
+    """
+    This function prepares the audio that is replayed into the Transcribe stand-in, as the capture pipeline would send
+    it.
+    :param wav: The path of a wav recording, or None for a synthetic recording of one spoken question.
+    :return: A list of audio chunks at the Transcribe sample rate.
+    """
+    from live_transcription import SAMPLE_RATE
+    from local_stubs import capture_chunks, read_wav, synthetic_speech
+    samples, rate = read_wav(wav) if wav else (synthetic_speech(bursts=1), 48000)
+    return capture_chunks(samples, rate, SAMPLE_RATE)
+
+
+def transcribe(question, chunks, latency=0.0):
+    """
+    This function transcribes a recording with the Transcribe stand-in, through the same code as a spoken question.
+    :param question: The text the stand-in transcribes the recording as.
+    :param chunks: The audio chunks of the recording.
+    :param latency: The processing latency of the stand-in per chunk.
+    :return: The finalized transcript.
+    """
+    from live_transcription import SAMPLE_RATE, transcribe_utterance
+    from local_stubs import FakeTranscribeStreamingClient, replay_chunks
+
+    async def run():
+        client = FakeTranscribeStreamingClient(phrases=[question], latency=latency)
+        stream = await client.start_stream_transcription(language_code="en-US", media_sample_rate_hz=SAMPLE_RATE,
+                                                         media_encoding="pcm")
+        return await transcribe_utterance(stream, replay_chunks(chunks))
+    return asyncio.run(run())
+
+
+def full_turn(question, chunks):
+    """
+    This function runs a whole turn: transcribing the question, embedding it, retrieving the examples, streaming the
+    answer and synthesizing it sentence by sentence, like a streamed answer in app.py.
+    :param question: The question the recording is transcribed as.
+    :param chunks: The audio chunks of the recording.
+    :return: A dictionary with the time to first token, time to first audio and total time of the turn.
+    """
+    import resources
+    from prompt_finder_and_invoke_llm import embed_question, prompt_finder_stream
+    from text_to_speech import SentenceSplitter, synthesize
+    pipeline = resources.get_pipeline()
+    start = time.perf_counter()
+    transcript = transcribe(question, chunks).strip()
+    query_vector = pipeline.run("embedding", embed_question, transcript)
+    splitter = SentenceSplitter()
+    segments = []
+    first_token = None
+    first_audio = []
+
+    def speak(sentences):
+        for sentence in sentences:
+            segments.append(pipeline.submit("tts", synthesize, sentence))
+            if len(segments) == 1:
+                # the first segment starts playing as soon as its audio is ready
+                segments[0].add_done_callback(lambda _: first_audio.append(time.perf_counter()))
+
+    for token in pipeline.stream("llm", prompt_finder_stream, transcript, None, query_vector):
+        first_token = first_token or time.perf_counter()
+        speak(splitter.feed(token))
+    speak(splitter.flush())
+    for segment in segments:
+        segment.result()
+    return {"time_to_first_token": first_token - start, "time_to_first_audio": first_audio[0] - start}
+
+
+def run(iterations, concurrency, wav=None, bedrock_latency=None, polly_latency=None, transcribe_latency=0.0):
+    """
+    This function runs all scenarios.
+    :param iterations: The number of calls per scenario.
+    :param concurrency: The number of calls in parallel.
+    :param wav: The recording the transcription scenarios replay, or None for a synthetic one.
+    :param bedrock_latency: The time to first token of the Bedrock stand-in, or None for its default.
+    :param polly_latency: The latency of the Polly stand-in, or None for its default.
+    :param transcribe_latency: The processing latency of the Transcribe stand-in per chunk.
+    :return: A dictionary with the results of every scenario, the peak RSS and the cold start.
+    """
+    results = {"cold_start": cold_start()}
+    import resources
+    from prompt_finder_and_invoke_llm import build_prompt, llm_answer_generator, prompt_finder
+    from tracing import tracer
+    resources.warm()
+    if bedrock_latency is not None:
+        resources.get_bedrock().latency = bedrock_latency
+    if polly_latency is not None:
+        resources.get_polly().latency = polly_latency
+    samples = resources.get_samples()
+    questions = [samples[i % len(samples)]["input"] for i in range(iterations)]
+    chunks = transcription_chunks(wav)
+
+    scenarios = {}
+    scenarios["prompt_finder"], _ = run_scenario(prompt_finder, questions, concurrency)
+    prompts = [build_prompt(question) for question in questions]
+    scenarios["llm_answer_generator"], _ = run_scenario(llm_answer_generator, prompts, concurrency)
+    scenarios["transcription"], _ = run_scenario(lambda question: transcribe(question, chunks, transcribe_latency),
+                                                 questions, concurrency)
+    scenarios["turn"], turns = run_scenario(lambda question: full_turn(question, chunks), questions, concurrency)
+    scenarios["turn"]["time_to_first_token_p50"] = float(np.median([turn["time_to_first_token"] for turn in turns]))
+    scenarios["turn"]["time_to_first_audio_p50"] = float(np.median([turn["time_to_first_audio"] for turn in turns]))
+    results.update({"scenarios": scenarios, "peak_rss_mb": peak_rss_mb(), "stages": tracer.percentiles(),
+                    "iterations": iterations, "concurrency": concurrency})
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    This function compares the results with the baseline.
+    :param results: The results of run().
+    :param baseline: The results of an earlier run.
+    :param tolerance: The allowed relative difference, for example 0.2 for 20%.
+    :return: A list of descriptions of the regressions, empty if there are none.
+    """
+    regressions = []
+    checks = [(f"{name}.{metric}", baseline["scenarios"][name][metric], results["scenarios"][name][metric], metric)
+              for name in baseline["scenarios"] if name in results["scenarios"]
+              for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER
+              if metric in baseline["scenarios"][name] and metric in results["scenarios"][name]]
+    checks.append(("peak_rss_mb", baseline["peak_rss_mb"], results["peak_rss_mb"], "peak_rss_mb"))
+    checks.append(("cold_start.total_seconds", baseline["cold_start"]["total_seconds"],
+                   results["cold_start"]["total_seconds"], "total_seconds"))
+    for label, before, after, metric in checks:
+        if metric in HIGHER_IS_BETTER:
+            if after < before * (1 - tolerance):
+                regressions.append(f"{label}: {before:.3f} -> {after:.3f}")
+        elif after > before * (1 + tolerance):
+            regressions.append(f"{label}: {before:.3f} -> {after:.3f}")
+    return regressions
+
+
+def print_report(results):
+    cold = results["cold_start"]
+    print(f"Cold start: {cold['total_seconds']:.2f}s in-process (imports {cold['import_seconds']:.2f}s, "
+          f"warm up {cold['warm_up_seconds']:.2f}s, first answer {cold['first_answer_seconds']:.2f}s), "
+          f"{cold['process_seconds']:.2f}s with interpreter start")
+    print(f"Peak RSS: {results['peak_rss_mb']:.0f} MB")
+    print(f"{'scenario':<22}{'calls/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, scenario in results["scenarios"].items():
+        print(f"{name:<22}{scenario['throughput']:>10.2f}{scenario['p50'] * 1000:>10.1f}"
+              f"{scenario['p95'] * 1000:>10.1f}{scenario['p99'] * 1000:>10.1f}")
+    turn = results["scenarios"]["turn"]
+    print(f"Turn: time to first token {turn['time_to_first_token_p50'] * 1000:.1f} ms, "
+          f"time to first audio {turn['time_to_first_audio_p50'] * 1000:.1f} ms (p50)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark against local stand-ins for the AWS services.")
+    parser.add_argument("--iterations", type=int, default=50, help="calls per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="calls in parallel")
+    parser.add_argument("--wav", help="a 16 bit wav recording to replay into the Transcribe stand-in")
+    parser.add_argument("--bedrock-latency", type=float, help="time to first token of the Bedrock stand-in")
+    parser.add_argument("--polly-latency", type=float, help="latency of the Polly stand-in")
+    parser.add_argument("--transcribe-latency", type=float, default=0.0, help="latency of the Transcribe stand-in")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="the stored results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--cold-start-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.cold_start_child:
+        cold_start_child()
+        return 0
+    results = run(args.iterations, args.concurrency, args.wav, args.bedrock_latency, args.polly_latency,
+                  args.transcribe_latency)
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, baselines depend on the host, run with --save-baseline on this host "
+              f"before changing the code to store one")
+        return 0
+    with open(args.baseline) as stored:
+        regressions = compare(results, json.load(stored), args.tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    print("No regressions against the baseline" if not regressions else f"{len(regressions)} regression(s)")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
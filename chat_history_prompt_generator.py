@@ -1,56 +1,240 @@
-# creating an empty array to store the question and answer dictionaries
-question_history = []
+import logging
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import deque
+from dataclasses import dataclass, field
+from prompt_budget import format_turn
+from resources import get_pipeline
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# loading in environment variables
+load_dotenv()
+
+# the number of most recent questions/answers that are kept word for word, older ones are summarized
+MAX_TURNS = int(os.getenv('chat_history_turns', 4))
+
+
+@dataclass
+class Turn:
+    """
+    A single question of the user and the answer of the LLM.
+    """
+    question: str
+    answer: str
+    timestamp: float = field(default_factory=time.time)
+    # set once the turn has been handed to the summarizer, so it is not summarized twice
+    summarized: bool = False
+
+
+class SQLiteConversationStore:
+    """
+    Optional persistence for the conversation memory, every turn is appended to a SQLite database in WAL mode, so
+    concurrent sessions can write without blocking each other's readers.
+    """
+
+    def __init__(self, path, session_id):
+        self.session_id = session_id
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS turns (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                "session_id TEXT NOT NULL, question TEXT, answer TEXT, timestamp REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, id)")
+        self.connection.commit()
+
+    def append(self, turn):
+        """
+        This function stores a single turn.
+        :param turn: The Turn to store.
+        """
+        with self.lock:
+            self.connection.execute("INSERT INTO turns (session_id, question, answer, timestamp) VALUES (?, ?, ?, ?)",
+                                    (self.session_id, turn.question, turn.answer, turn.timestamp))
+            self.connection.commit()
+
+    def load(self, limit):
+        """
+        This function loads the most recent turns of the session.
+        :param limit: The maximum number of turns to load.
+        :return: A list of the most recent turns, oldest first.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT question, answer, timestamp FROM turns WHERE session_id = ? "
+                                           "ORDER BY id DESC LIMIT ?", (self.session_id, limit)).fetchall()
+        return [Turn(*row) for row in reversed(rows)]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class RollingSummarizer:
+    """
+    Compresses the turns that fall out of the conversation memory into a rolling summary. The summary is generated on
+    the llm stage of the shared request pipeline (see pipeline.py), off the critical path of answering the next
+    question, and only when the stage has a free slot, so it never makes an answer wait.
+    """
+
+    def __init__(self, summarize):
+        # summarize is called with the current summary (or None) and a list of turns, and returns the new summary
+        self.summarize = summarize
+
+    def submit(self, memory, *turns):
+        """
+        This function queues turns to be added to the summary of a conversation memory.
+        :param memory: The ConversationMemory the turns were removed from.
+        :param turns: The Turns that were removed, or that no longer fit the token budget of the prompt.
+        :return: The future of the summary update, or None if the llm stage is busy, the turns are then summarized
+        together with the next ones.
+        """
+        with memory.lock:
+            memory.unsummarized.extend(turns)
+        return get_pipeline().stages["llm"].try_submit(self._update, memory)
+
+    def _update(self, memory):
+        while True:
+            # a single update runs per memory, a second one leaves its turns to it instead of holding a worker
+            if not memory.summary_lock.acquire(blocking=False):
+                return memory.summary
+            try:
+                while True:
+                    with memory.lock:
+                        turns, memory.unsummarized = memory.unsummarized, []
+                    if not turns:
+                        break
+                    try:
+                        memory.summary = self.summarize(memory.summary, turns)
+                    except Exception:
+                        # keeping the turns, so they are summarized together with the next ones
+                        logger.exception("Summarizing the chat history failed")
+                        with memory.lock:
+                            memory.unsummarized = turns + memory.unsummarized
+                        return memory.summary
+            finally:
+                memory.summary_lock.release()
+            # turns that were queued while the lock was released would otherwise wait for the next update
+            with memory.lock:
+                if not memory.unsummarized:
+                    return memory.summary
+
+
+class ConversationMemory:
+    """
+    The conversation memory of a single session: a bounded deque of the most recent turns, kept in memory and updated
+    one turn at a time. When a new turn is added to a full memory, the oldest one is handed to the summarizer.
+    """
+
+    def __init__(self, max_turns=MAX_TURNS, store=None, summarizer=None):
+        self.turns = deque(maxlen=max_turns)
+        self.store = store
+        self.summarizer = summarizer
+        # the rolling summary of the turns that no longer fit in the memory
+        self.summary = None
+        self.unsummarized = []
+        self.lock = threading.Lock()
+        self.summary_lock = threading.Lock()
+        if store is not None:
+            # restoring the most recent turns of the session, and closing the connection once the memory is discarded
+            self.turns.extend(store.load(max_turns))
+            weakref.finalize(self, store.close)
+
+    def add_turn(self, question, answer):
+        """
+        This function adds the latest question and answer to the memory, and to the store if there is one.
+        :param question: The question of the user.
+        :param answer: The answer of the LLM.
+        :return: The Turn that was added.
+        """
+        turn = Turn(question, answer)
+        with self.lock:
+            evicted = self.turns[0] if len(self.turns) == self.turns.maxlen else None
+            self.turns.append(turn)
+            # a turn that was already summarized because it did not fit the prompt is not summarized again
+            if evicted is not None and evicted.summarized:
+                evicted = None
+            elif evicted is not None:
+                evicted.summarized = True
+        if self.store is not None:
+            self.store.append(turn)
+        if evicted is not None and self.summarizer is not None:
+            self.summarizer.submit(self, evicted)
+        return turn
+
+    def summarize_dropped(self, turns):
+        """
+        This function hands the turns that are still in the memory, but no longer fit the token budget of the prompt (see
+        prompt_budget.py), to the summarizer, so the following prompts still know about them through the summary.
+        :param turns: The dropped_turns of a PromptPlan.
+        """
+        if self.summarizer is None:
+            return
+        with self.lock:
+            turns = [turn for turn in turns if not turn.summarized]
+            for turn in turns:
+                turn.summarized = True
+        if turns:
+            self.summarizer.submit(self, *turns)
+
+    def __len__(self):
+        return len(self.turns)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.turns))
+
+    def format_history(self):
+        """
+        This function formats the summary and the questions and answers in the memory into a prompt, so they can be
+        injected into the final prompt in the prompt_finder_and_invoke_llm.py file.
+        :return: A string containing all the chat history questions and answers, or None if there is no history.
+        """
+        if not self.turns and not self.summary:
+            return None
+        summary = f"\n\nSummary of the earlier conversation: {self.summary}" if self.summary else ""
+        # formatting the prompt, with question and answer from previous asks
+        return summary + "".join(format_turn(turn) for turn in self)
+
+
+def conversation_memory(session_state, session_id, summarizer=None):
+    """
+    This function returns the conversation memory of a session, creating it the first time. If chat_history_db is set in
+    the .env file, the turns are also persisted to that SQLite database, and the most recent turns of an earlier session
+    with the same id are restored.
+    :param session_state: The session state of the streamlit session.
+    :param session_id: The stable id of the conversation, the turns are stored and restored under this id.
+    :param summarizer: The RollingSummarizer that summarizes the turns that no longer fit in the memory.
+    :return: The ConversationMemory of the session.
+    """
+    if "conversation_memory" not in session_state:
+        store = None
+        if os.getenv('chat_history_db'):
+            store = SQLiteConversationStore(os.getenv('chat_history_db'), session_id)
+        session_state["conversation_memory"] = ConversationMemory(store=store, summarizer=summarizer)
+    return session_state["conversation_memory"]
 
 
 def chat_history(session_state):
     """
-    This function takes the current session state, including the user question and the LLM response, parses it, and formats
-    it into a prompt. It preserves the session state up to 4 questions/answers and then removes the oldest question/answer.
-    It writes the formatted questions and answers to the chat_history.txt file so that it can be easily injected to the
-    final prompt in the model_invoker.py file.
+    This function takes the current session state, including the user question and the LLM response, and adds the
+    latest question/answer to the conversation memory of the session. The memory preserves up to 4 questions/answers
+    (chat_history_turns) and then moves the oldest question/answer into the rolling summary.
     :param session_state: The session state that is passed in from the front end that contains each individual user question
     and LLM answer.
     """
-    # initializing an empty question string
+    # the latest question and answer are the last two messages in the session state
     question = ""
-    # initializing an empty answer string
     answer = ""
-    # initializing an empty dictionary to store the specific question and related answer
-    question_answer = dict()
-    # looping through the session state dictionary, and gathering the question and answer and storing it in a dictionary
-    for message in session_state.get('messages'):
+    for message in session_state.get('messages')[-2:]:
         # if the message is from a user, it is a question
         if message.get('role') == 'user':
-            # storing each user message in the question variable
             question = message.get('content')
         # if the message is from a assistant, it is an answer
         if message.get('role') == 'assistant':
-            # storing each assistant message in the answer variable
             answer = message.get('content')
-        # storing the formatted answer and question in a dictionary for each individual question/answer pair
-        question_answer = {
-            "question": question,
-            "answer": answer
-        }
-    # adding each question_answer dictionary to a list
-    question_history.append(question_answer)
-    # simple logic to ensure that the chat history is only kept for the most recent 4 questions/answers
-    if len(question_history) > 4:
-        # removing the oldest question/answer when the question_history list is larger than 4
-        question_history.remove(question_history[0])
-    else:
-        pass
-    # initiating the final prompt string, where each question answer will be formatted and stored
-    final_prompt = ""
-    # looping through the list containing each question/answer pair
-    for question_answer_pair in question_history:
-        # formatting the prompt, with question and answer from previous asks
-        final_prompt += f"""
-        
-        Question: {question_answer_pair.get('question')}
-        
-        Answer: {question_answer_pair.get('answer')}"""
-    # opening a text file, and writing the contents of the final prompt string to it, so it can be used in other files
-    with open('chat_history.txt', 'w') as history:
-        # writing the contents of the formatted questions and answers from previous questions/answers to the txt file
-        history.write(final_prompt)
\ No newline at end of file
+    # the memory was created with the id of the session by conversation_memory()
+    session_state["conversation_memory"].add_turn(question, answer)
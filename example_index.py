@@ -0,0 +1,182 @@
+import hashlib
+import os
+import numpy as np
+
+# the sample prompts that are used for few-shot prompting
+SAMPLES_PATH = "sample_prompts/generic_samples.yaml"
+# the directory the prebuilt example index is written to
+INDEX_DIR = "sample_prompts/.index"
+# the embedding model used to embed the sample prompts and the users question
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+def example_to_text(example):
+    """
+    This function turns a single example into the text that is embedded, joining the example values sorted by key. This
+    mirrors what the SemanticSimilarityExampleSelector used to embed, so the retrieved examples do not change.
+    :param example: A dictionary containing the input, description and answer of a sample prompt.
+    :return: The text that represents the example in the index.
+    """
+    return " ".join(str(example[key]) for key in sorted(example))
+
+
+def example_hash(example):
+    """
+    This function creates a content hash of a single example, which is used to decide if an example has to be re-embedded.
+    :param example: A dictionary containing the input, description and answer of a sample prompt.
+    :return: A hex string uniquely identifying the content of the example.
+    """
+    return hashlib.sha256(example_to_text(example).encode("utf-8")).hexdigest()
+
+
+def index_path(model_name=MODEL_NAME, index_dir=INDEX_DIR):
+    """
+    This function returns the location of the compiled index. The file is keyed by the embedding model name, so
+    switching models never mixes vectors produced by different models.
+    :param model_name: The name of the embedding model the index is built with.
+    :param index_dir: The directory the index file is stored in.
+    :return: The path of the Arrow file of the index.
+    """
+    # creating a short, file system safe key for the model name
+    model_key = hashlib.sha256(model_name.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(index_dir, f"{model_key}.arrow")
+
+
+class ArrowExamples:
+    """
+    The sample prompts stored in the compiled index, read straight from the memory-mapped Arrow table. An example is
+    only turned into a dictionary when it is accessed, so nothing is parsed at startup.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.columns = [name for name in table.column_names if name not in ("hash", "embedding")]
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def __getitem__(self, row):
+        # fields an example does not have are stored as nulls
+        values = {name: self.table.column(name)[int(row)].as_py() for name in self.columns}
+        return {name: value for name, value in values.items() if value is not None}
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+
+class ExampleIndex:
+    """
+    The prebuilt index of all sample prompts: the examples and one normalized embedding row per example.
+    """
+
+    def __init__(self, examples, vectors):
+        self.examples = examples
+        self.vectors = vectors
+
+
+def _read_table(path):
+    """
+    This function memory-maps a compiled index, the columns are read from the page cache instead of being copied.
+    :param path: The path of the Arrow file.
+    :return: The Arrow table, or None if there is no index yet.
+    """
+    import pyarrow as pa
+    if not os.path.exists(path):
+        return None
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+def _vectors(table):
+    # a zero-copy view of the fixed size embedding lists as a float32 matrix
+    embedding = table.column("embedding").combine_chunks()
+    return embedding.values.to_numpy(zero_copy_only=True).reshape(len(embedding), embedding.type.list_size)
+
+
+def _parse_samples(raw_samples):
+    import yaml
+    # the C parser of libyaml is an order of magnitude faster, if PyYAML was built with it
+    return yaml.load(raw_samples, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def build_index(get_embeddings, samples_path=SAMPLES_PATH, model_name=MODEL_NAME, index_dir=INDEX_DIR):
+    """
+    This function compiles the sample prompts yaml file into a single Arrow file with the example texts and their
+    embeddings. If an index already exists, only the examples that are new or have changed since the last build are
+    embedded again, all other vectors are reused.
+    :param get_embeddings: A function without arguments that returns the embedding class, it is only called when
+    examples have to be embedded.
+    :param samples_path: The path of the sample prompts yaml file.
+    :param model_name: The name of the embedding model, used to key the index file.
+    :param index_dir: The directory the index file is written to.
+    :return: The freshly built ExampleIndex.
+    """
+    import pyarrow as pa
+    path = index_path(model_name, index_dir)
+    # reading the raw yaml once, to hash it and to parse the examples
+    with open(samples_path, "rb") as stream:
+        raw_samples = stream.read()
+    examples = _parse_samples(raw_samples)
+    hashes = [example_hash(example) for example in examples]
+    # mapping the hash of every previously embedded example to its stored vector
+    previous = {}
+    table = _read_table(path)
+    if table is not None:
+        previous = dict(zip(table.column("hash").to_pylist(), _vectors(table)))
+    # only the new or changed examples are sent through the embedding model
+    missing = [row for row, new_hash in enumerate(hashes) if new_hash not in previous]
+    new_vectors = get_embeddings().embed_documents([example_to_text(examples[row]) for row in missing]) \
+        if missing else []
+    new_vectors = dict(zip(missing, new_vectors))
+    dimension = len(next(iter(new_vectors.values()))) if new_vectors else len(next(iter(previous.values())))
+    vectors = np.empty((len(examples), dimension), dtype=np.float32)
+    for row, new_hash in enumerate(hashes):
+        vectors[row] = new_vectors[row] if row in new_vectors else previous[new_hash]
+    # normalizing every row so a single dot product gives the cosine similarity
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.where(norms == 0, 1.0, norms)
+    # one string column per example field, the content hashes, and the embeddings as fixed size lists
+    keys = sorted({key for example in examples for key in example})
+    columns = {key: pa.array([None if example.get(key) is None else str(example[key]) for example in examples],
+                             pa.string()) for key in keys}
+    columns["hash"] = pa.array(hashes, pa.string())
+    columns["embedding"] = pa.FixedSizeListArray.from_arrays(pa.array(vectors.ravel(), pa.float32()), dimension)
+    table = pa.table(columns).replace_schema_metadata({
+        "model_name": model_name,
+        "samples_hash": hashlib.sha256(raw_samples).hexdigest(),
+    })
+    # writing to a temporary file first, so a reader never sees a half written index
+    os.makedirs(index_dir, exist_ok=True)
+    with pa.OSFile(path + ".tmp", "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(path + ".tmp", path)
+    print(f"Example index built: {len(missing)} of {len(examples)} examples embedded\n")
+    table = _read_table(path)
+    return ExampleIndex(ArrowExamples(table), _vectors(table))
+
+
+def load_index(get_embeddings, samples_path=SAMPLES_PATH, model_name=MODEL_NAME, index_dir=INDEX_DIR):
+    """
+    This function loads the compiled example index, memory-mapping the examples and vectors. If the index is missing
+    or the sample prompts yaml file changed since it was built, the index is (incrementally) rebuilt first.
+    :param get_embeddings: A function without arguments that returns the embedding class, only called when the index
+    has to be (re)built.
+    :param samples_path: The path of the sample prompts yaml file.
+    :param model_name: The name of the embedding model the index is built with.
+    :param index_dir: The directory the index file is stored in.
+    :return: The ExampleIndex for the current sample prompts.
+    """
+    table = _read_table(index_path(model_name, index_dir))
+    # hashing the yaml file to make sure the index still matches the sample prompts
+    with open(samples_path, "rb") as stream:
+        samples_hash = hashlib.sha256(stream.read()).hexdigest()
+    metadata = (table.schema.metadata or {}) if table is not None else {}
+    if metadata.get(b"samples_hash") != samples_hash.encode("ascii"):
+        return build_index(get_embeddings, samples_path, model_name, index_dir)
+    return ExampleIndex(ArrowExamples(table), _vectors(table))
+
+
+if __name__ == "__main__":
+    # offline build step: python example_index.py
+    from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+    build_index(lambda: HuggingFaceEmbeddings(model_name=MODEL_NAME))
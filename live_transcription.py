@@ -1,48 +1,128 @@
 # Amazon Transcribe Streaming SDK in Python example used as reference:
 # https://github.com/awslabs/amazon-transcribe-streaming-sdk/blob/develop/examples/simple_mic.py
 
-import streamlit as st
 import asyncio
+import os
+import time
+import weakref
+import numpy as np
 import sounddevice as sd
-from threading import Thread, Timer
+from threading import Thread
+from audio_capture import CapturePipeline
+from tracing import tracer
 
 # importing TranscribeStreamingClient from Amazon Transcribe for live audio transcription
 from amazon_transcribe.client import TranscribeStreamingClient
 from amazon_transcribe.handlers import TranscriptResultStreamHandler
 from amazon_transcribe.model import TranscriptEvent
+from dotenv import load_dotenv
+
+# loading in environment variables
+load_dotenv()
+
+# the sample rate the microphone is recorded at
+CAPTURE_SAMPLE_RATE = int(os.getenv('capture_sample_rate', 48000))
+# the number of frames the microphone hands over per block, at the capture rate
+CAPTURE_BLOCK_FRAMES = int(os.getenv('capture_block_frames', 2048))
+# the sample rate the audio is resampled to before it is sent to Transcribe (16000 or 8000 is plenty for speech)
+SAMPLE_RATE = int(os.getenv('transcribe_sample_rate', 16000))
+# the length of the audio chunks sent to Transcribe, in milliseconds
+CHUNK_MS = int(os.getenv('transcribe_chunk_ms', 100))
+# seconds of silence after which the question is considered complete
+SILENCE_TIMEOUT = float(os.getenv('silence_timeout', 3))
+# the smallest interval, in seconds, at which the end of the question is checked
+SILENCE_RESOLUTION = float(os.getenv('silence_resolution', 0.1))
+# audio frames louder than this level (in dBFS) count as speech, even before Transcribe returns any words
+VAD_THRESHOLD_DBFS = float(os.getenv('vad_threshold_dbfs', -40))
+# a prefetched stream that waited longer than this, in seconds, is replaced before use (Transcribe times out after 15)
+STREAM_MAX_IDLE = float(os.getenv('transcribe_stream_max_idle', 10))
+# how long to wait for the final transcript after the audio stream has been ended
+FINAL_TRANSCRIPT_TIMEOUT = 2.0
+# a session that was not asked a question for this many seconds releases its audio device and prefetched stream
+SESSION_IDLE_TIMEOUT = float(os.getenv('transcription_idle_timeout', 300))
+
+
+class EndOfUtterance:
+    """
+    Keeps track of the last moment the user was speaking, based on transcript events and the energy of the microphone
+    audio, and detects when the user has been silent for long enough.
+    """
+
+    def __init__(self, silence_timeout=SILENCE_TIMEOUT, resolution=SILENCE_RESOLUTION):
+        self.silence_timeout = silence_timeout
+        self.resolution = resolution
+        self.last_activity = asyncio.get_running_loop().time()
+
+    def mark(self):
+        """
+        This function records that the user is speaking right now, which restarts the silence window.
+        """
+        self.last_activity = asyncio.get_running_loop().time()
+
+    async def wait(self):
+        """
+        This function returns as soon as the user has been silent for the silence timeout. Instead of polling, it sleeps
+        until the current silence deadline, and only sleeps again if there was activity in the meantime.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            remaining = self.last_activity + self.silence_timeout - loop.time()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(max(remaining, self.resolution))
+
+
+def is_speech(chunk, threshold_dbfs=VAD_THRESHOLD_DBFS):
+    """
+    This function is a simple voice activity detector, it checks if an audio frame is loud enough to contain speech.
+    :param chunk: The raw int16 audio frame.
+    :param threshold_dbfs: The level in dBFS above which the frame counts as speech.
+    :return: True if the frame is louder than the threshold.
+    """
+    samples = np.frombuffer(chunk, dtype=np.int16).astype(np.float32)
+    if samples.size == 0:
+        return False
+    rms = np.sqrt(np.mean(samples * samples))
+    return 20 * np.log10(max(rms, 1.0) / 32768) > threshold_dbfs
 
-# Initialize empty transcript and timestamp to check if user stops talking
-transcript = ""
-last_transcript_time = None
 
 # event handler for transcription coming from microphone
 class MyEventHandler(TranscriptResultStreamHandler):
+    def __init__(self, transcript_result_stream, end_of_utterance, on_partial=None):
+        super().__init__(transcript_result_stream)
+        self.transcript = ""
+        self.end_of_utterance = end_of_utterance
+        # called with the transcript so far, including the words that are not final yet, whenever it changes
+        self.on_partial = on_partial
+
     async def handle_transcript_event(self, transcript_event: TranscriptEvent):
-        global transcript, last_transcript_time
         results = transcript_event.transcript.results
         # iterate through words being transcribed
         for result in results:
             for alt in result.alternatives:
-                # reset 3 second time check
-                last_transcript_time = asyncio.get_event_loop().time()
-                # if the word is partial (i.e. not a completed word as user speaks), skip
+                # reset the silence window
+                self.end_of_utterance.mark()
+                # if the word is partial (i.e. not a completed word as user speaks), it is only used for speculation
                 if result.is_partial:
+                    if self.on_partial is not None:
+                        self.on_partial((self.transcript + ' ' + alt.transcript).strip())
                     continue
                 # else, word is completed and can be added to full sentence
                 else:
-                    transcript += ' ' + alt.transcript
+                    self.transcript += ' ' + alt.transcript
                     # print finalized sentence to terminal for user to see
-                    print("Transcription:" + transcript +"\n")
+                    print("Transcription:" + self.transcript + "\n")
+                    if self.on_partial is not None:
+                        self.on_partial(self.transcript.strip())
 
-# asynchronous generator for microphone stream
 
 def get_default_input_device():
     devices = sd.query_devices()
     input_devices = [i for i, d in enumerate(devices) if d['max_input_channels'] > 0]
-    
+
     if not input_devices:
         raise sd.PortAudioError("No input devices available")
-    
+
     # Select the first input device if default fails
     default_device = sd.default.device[0]
     if default_device == -1:
@@ -50,111 +130,292 @@ def get_default_input_device():
         return input_devices[0]
     return default_device
 
-async def mic_stream():
-    loop = asyncio.get_event_loop()
-    input_queue = asyncio.Queue()
 
-    def callback(indata, frame_count, time_info, status):
-        loop.call_soon_threadsafe(input_queue.put_nowait, (bytes(indata), status))
+class MicrophoneStream:
+    """
+    Keeps the audio device open for the whole transcription session. Frames are only captured while a question is being
+    listened to, the rest of the time (for example while the answer is being spoken) they are dropped.
+    """
 
-    try:
-        # Use the determined input device
-        device_id = get_default_input_device()
-        
-        stream = sd.RawInputStream(
-            device=device_id,
-            channels=1,
-            samplerate=48000,
-            callback=callback,
-            blocksize=1024 * 2,
-            dtype="int16",
-        )
-        with stream:
-            while True:
-                indata, status = await input_queue.get()
-                yield indata, status
-    except sd.PortAudioError as e:
-        print(f"Error initializing audio stream: {e}")
-        raise
+    def __init__(self, loop):
+        self.loop = loop
+        # the microphone blocks are resampled and packed into transcription sized chunks (see audio_capture.py)
+        self.pipeline = CapturePipeline(CAPTURE_SAMPLE_RATE, SAMPLE_RATE, CHUNK_MS)
+        self.ready = asyncio.Event()
+        self.status = None
+        self.listening = False
+        try:
+            # Use the determined input device
+            self.stream = sd.RawInputStream(
+                device=get_default_input_device(),
+                channels=1,
+                samplerate=CAPTURE_SAMPLE_RATE,
+                callback=self._callback,
+                blocksize=CAPTURE_BLOCK_FRAMES,
+                dtype="int16",
+            )
+            self.stream.start()
+        except sd.PortAudioError as e:
+            print(f"Error initializing audio stream: {e}")
+            raise
+
+    def _callback(self, indata, frame_count, time_info, status):
+        # the block is resampled straight from the buffer of the audio device, the event loop is only woken up once a
+        # full chunk is ready
+        if self.listening and self.pipeline.push(indata):
+            self.status = status
+            self.loop.call_soon_threadsafe(self.ready.set)
 
+    def listen(self):
+        """
+        This function starts capturing audio frames, dropping anything left over from the previous question.
+        """
+        self.pipeline.reset()
+        self.ready.clear()
+        self.listening = True
+
+    def pause(self):
+        """
+        This function stops capturing audio frames, the audio device stays open.
+        """
+        self.listening = False
+
+    async def chunks(self):
+        """
+        This function is an asynchronous generator for the microphone stream.
+        :return: The resampled audio chunks and the last status of the audio device, as they are recorded.
+        """
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            chunk = self.pipeline.pop()
+            while chunk is not None:
+                yield chunk, self.status
+                chunk = self.pipeline.pop()
+
+    def close(self):
+        self.listening = False
+        self.stream.stop()
+        self.stream.close()
 
 
  # This connects the raw audio chunks generator coming from the microphone
- # and passes them along to the transcription stream.
-async def write_chunks(stream):
-    async for chunk, status in mic_stream():
-        await stream.input_stream.send_audio_event(audio_chunk=chunk)
+ # and passes them along to the transcription stream, until the end of the question is detected.
+async def write_chunks(stream, audio, end_of_utterance, stop):
+    sent = 0
+    try:
+        async for chunk, status in audio:
+            # loud audio frames count as speech, so the silence window restarts before any words are transcribed
+            if is_speech(chunk):
+                end_of_utterance.mark()
+            await stream.input_stream.send_audio_event(audio_chunk=chunk)
+            sent += len(chunk)
+            if stop.is_set():
+                break
+    finally:
+        await audio.aclose()
+    # ending the stream cleanly, Transcribe then finalizes the last words and closes the output stream
     await stream.input_stream.end_stream()
+    # the number of audio bytes sent to Transcribe
+    return sent
 
-# function to start transcription and connect to chosen AWS region
-async def basic_transcribe(language_code):
-    client = TranscribeStreamingClient(region="us-east-1")
-    # start transcription to generate our async stream
-    stream = await client.start_stream_transcription(
-        language_code=language_code,
-        media_sample_rate_hz=48000,
-        media_encoding="pcm",
-    )
+# function to transcribe a single question from an already opened transcription stream
+async def transcribe_utterance(stream, audio, on_partial=None):
     # instantiate our handler and start processing events
-    handler = MyEventHandler(stream.output_stream)
-    await asyncio.gather(write_chunks(stream), handler.handle_events())
-
-# global variable for event loop
-global_loop = None
-
-# function to start transcription process
-def start_transcribe(language_code):
-    global global_loop, last_transcript_time, transcript
-    transcript = ""
-    # create new event loop with thread
-    global_loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(global_loop)
-    last_transcript_time = global_loop.time()
-    # run loop until user stops talking 
-    try:
-        global_loop.run_until_complete(basic_transcribe(language_code))
-    except RuntimeError as e:
-        if "Event loop stopped before Future completed" not in str(e):
-            raise
+    end_of_utterance = EndOfUtterance()
+    handler = MyEventHandler(stream.output_stream, end_of_utterance, on_partial)
+    stop = asyncio.Event()
+    capture_start = time.perf_counter()
+    writer = asyncio.create_task(write_chunks(stream, audio, end_of_utterance, stop))
+    events = asyncio.create_task(handler.handle_events())
+    silence = asyncio.create_task(end_of_utterance.wait())
+    # while transcript is coming in, continue to stream audio, after the silence timeout stop sending audio
+    await asyncio.wait({writer, events, silence}, return_when=asyncio.FIRST_COMPLETED)
+    tracer.record("audio_capture", capture_start)
+    if silence.done():
+        # the time between the last speech and the end of the question
+        silence_seconds = asyncio.get_running_loop().time() - end_of_utterance.last_activity
+        tracer.record("silence_wait", time.perf_counter() - silence_seconds)
+    stop.set()
+    silence.cancel()
+    with tracer.span("transcription_finalization") as span:
+        try:
+            span.set(audio_bytes=await writer)
+            # waiting for the final transcript events that arrive after the stream has been ended
+            await asyncio.wait_for(events, timeout=FINAL_TRANSCRIPT_TIMEOUT)
+        except asyncio.TimeoutError:
+            span.set(timed_out=True)
+        finally:
+            events.cancel()
+        span.set(transcript_characters=len(handler.transcript.strip()))
+    return handler.transcript
+
+
+async def _release(handles):
+    """
+    This function closes the audio device and the prefetched stream of a transcription session.
+    :param handles: The dictionary of the open microphone, prefetched stream and idle timer of the session.
+    """
+    timer = handles.pop("idle_timer", None)
+    if timer is not None:
+        timer.cancel()
+    microphone = handles.pop("microphone", None)
+    if microphone is not None:
+        microphone.close()
+    next_stream = handles.pop("next_stream", None)
+    if next_stream is not None:
+        next_stream.cancel()
+        if next_stream.done() and not next_stream.cancelled() and next_stream.exception() is None:
+            try:
+                await next_stream.result()[0].input_stream.end_stream()
+            except Exception:
+                pass
+
+
+def _release_soon(loop, handles):
+    # called when a session is garbage collected, for example when its streamlit session ended, possibly on the event
+    # loop thread itself, so the release is only scheduled
+    if not loop.is_closed():
+        asyncio.run_coroutine_threadsafe(_release(handles), loop)
+
+
+class TranscriptionSession:
+    """
+    A long-lived transcription session for one user. The audio device stays open and the Transcribe client is reused
+    between questions, and the stream for the next question is opened while the current answer is being spoken, so
+    there is no setup latency between the end of an answer and the start of the next question. The session runs on an
+    event loop in a background thread, so it can be used from the streamlit script thread across reruns. All of its state
+    lives on the session, so many sessions can share one event loop.
+
+    The audio device and the first stream are only opened when the first question is asked. A session that is not asked
+    a question for `idle_timeout` seconds releases them again until the next question, and a session that is garbage
+    collected without being closed releases them as well.
+    """
+
+    def __init__(self, language_code, region="us-east-1", max_idle=STREAM_MAX_IDLE, loop=None,
+                 idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.language_code = language_code
+        self.region = region
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.closed = False
+        # without a shared loop, the session starts its own loop and stops it again when it is closed
+        self.owns_loop = loop is None
+        self.loop = loop or asyncio.new_event_loop()
+        if self.owns_loop:
+            self.thread = Thread(target=self.loop.run_forever, daemon=True)
+            self.thread.start()
+        # the microphone, the prefetched stream and the idle timer, kept apart from the session so they can be released
+        # without a reference to it
+        self.handles = {}
+        self.finalizer = weakref.finalize(self, _release_soon, self.loop, self.handles)
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    async def _start(self):
+        # function to start transcription and connect to chosen AWS region
+        self.client = TranscribeStreamingClient(region=self.region)
 
-# function to terminate thread
-def stop_transcribe():
-    global global_loop
-    global_loop.call_soon_threadsafe(global_loop.stop)
-
-# function to stop transcription after silence is detected
-def stop_transcribe_after_silence():
-    timer = Timer(0.1, stop_transcribe)
-    timer.start()
-
-# function to monitor transcription progress
-def monitor_transcription():
-    global last_transcript_time
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    # while transcript is coming in, continue to stream audio
-    # else, if after 3 seconds of silence, terminate thread and transcription job
-    while True:
-        current_time = loop.time()
-        if last_transcript_time and current_time - last_transcript_time > 3:
-            stop_transcribe_after_silence()
-            break
-        loop.run_until_complete(asyncio.sleep(1))
-
-# main function to start transcription process
+    @property
+    def microphone(self):
+        # opening the audio device when the first question is asked, or after the session was idle
+        if "microphone" not in self.handles:
+            self.handles["microphone"] = MicrophoneStream(self.loop)
+        return self.handles["microphone"]
+
+    async def _open_stream(self):
+        # start transcription to generate our async stream
+        stream = await self.client.start_stream_transcription(
+            language_code=self.language_code,
+            media_sample_rate_hz=SAMPLE_RATE,
+            media_encoding="pcm",
+        )
+        return stream, self.loop.time()
+
+    def _prefetch(self):
+        # opening the stream for the next question in the background
+        self.handles["next_stream"] = asyncio.ensure_future(self._open_stream())
+        # releasing the microphone and the stream if no question is asked for a while, the timer only holds the handles
+        self.handles["idle_timer"] = self.loop.call_later(
+            self.idle_timeout, lambda handles: asyncio.ensure_future(_release(handles)), self.handles)
+
+    async def _take_stream(self):
+        timer = self.handles.pop("idle_timer", None)
+        if timer is not None:
+            timer.cancel()
+        next_stream = self.handles.pop("next_stream", None)
+        if next_stream is None:
+            # the first question of the session, or the session was idle
+            return (await self._open_stream())[0]
+        try:
+            stream, opened_at = await next_stream
+        except Exception as e:
+            print(f"Error opening the transcription stream in the background, retrying: {e}")
+            return (await self._open_stream())[0]
+        # Transcribe closes a stream that receives no audio for 15 seconds, so a stream that waited too long is replaced
+        if self.loop.time() - opened_at > self.max_idle:
+            try:
+                await stream.input_stream.end_stream()
+            except Exception:
+                pass
+            stream, _ = await self._open_stream()
+        return stream
+
+    async def next_utterance(self, on_partial=None):
+        """
+        This function transcribes the next question, from the moment it is called until the user is silent.
+        :param on_partial: Called on the event loop with the transcript so far whenever it changes, it must not block.
+        :return: The finalized transcript of the question.
+        """
+        stream = await self._take_stream()
+        microphone = self.microphone
+        microphone.listen()
+        try:
+            return await transcribe_utterance(stream, microphone.chunks(), on_partial)
+        finally:
+            microphone.pause()
+            # pre-opening the stream for the next question while the answer is being spoken
+            if not self.closed:
+                self._prefetch()
+
+    async def utterances(self):
+        """
+        This function is an asynchronous iterator over the questions of the user, it can be used from any event loop.
+        :return: The finalized transcript of every question.
+        """
+        while not self.closed:
+            yield await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self.next_utterance(), self.loop))
+
+    def listen(self, on_partial=None):
+        """
+        This function transcribes the next question, blocking until the user is silent.
+        :param on_partial: Called on the event loop with the transcript so far whenever it changes, it must not block.
+        :return: The finalized transcript of the question.
+        """
+        return asyncio.run_coroutine_threadsafe(self.next_utterance(on_partial), self.loop).result()
+
+    def close(self):
+        """
+        This function closes the audio device and the prefetched stream, and stops the event loop if the session owns it.
+        """
+        self.closed = True
+        self.finalizer.detach()
+        try:
+            asyncio.run_coroutine_threadsafe(_release(self.handles), self.loop).result()
+        finally:
+            if self.owns_loop:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.thread.join()
+                self.loop.close()
+
+# main function to transcribe a single question
 def main(language_code):
-    global last_transcript_time
-    # start transcription in a separate thread
-    transcribe_thread = Thread(target=start_transcribe, args=(language_code,))
-    transcribe_thread.start()
-    # Start monitoring transcription progress in a separate thread
-    monitor_thread = Thread(target=monitor_transcription)
-    monitor_thread.start()
     # inform user about transcription start
     print('Transcription started!\n')
-    # wait for transcription and monitoring threads to finish
-    transcribe_thread.join()
-    monitor_thread.join()
+    session = TranscriptionSession(language_code)
+    try:
+        transcript = session.listen()
+    finally:
+        session.close()
     print('Transcription finished\n')
     # return finalized transcript to app.py for Bedrock invocation
     return transcript
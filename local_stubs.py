@@ -0,0 +1,405 @@
+"""
+Local stand-ins for the AWS services this app calls, so the audio, transcription and speech pipeline can be exercised
+offline. Set tts_backend=stub in the .env file to use the Polly stand-in in the app, and llm_backend=stub to use the
+Bedrock stand-in. benchmark.py runs the app against these stand-ins.
+
+Check that the 16 kHz capture pipeline produces the same transcript as sending the raw 48 kHz microphone audio:
+
+    python local_stubs.py verify-capture [recording.wav] ["first phrase" "second phrase" ...]
+"""
+import asyncio
+import hashlib
+import io
+import json
+import sys
+import threading
+import time
+import wave
+import numpy as np
+from amazon_transcribe.handlers import TranscriptResultStreamHandler
+from amazon_transcribe.model import Alternative, Result, Transcript, TranscriptEvent
+from audio_capture import CapturePipeline
+
+
+def read_wav(path):
+    """
+    This function reads a 16 bit wav file, mixing it down to mono.
+    :param path: The path of the wav file.
+    :return: A tuple of the int16 samples and the sample rate.
+    """
+    with wave.open(path, "rb") as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"{path} must contain 16 bit audio")
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+        channels = wav.getnchannels()
+        rate = wav.getframerate()
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return samples, rate
+
+
+def synthetic_speech(rate=48000, bursts=3, burst_seconds=0.8, gap_seconds=0.6, seed=0):
+    """
+    This function creates a test recording of speech-like bursts (band-limited noise with a few formant tones),
+    separated by silence, for when no real recording is at hand.
+    :param rate: The sample rate of the recording.
+    :param bursts: The number of bursts, every burst is transcribed as one phrase.
+    :param burst_seconds: The length of every burst.
+    :param gap_seconds: The silence before, between and after the bursts.
+    :param seed: The random seed of the noise.
+    :return: The int16 samples.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(rate * burst_seconds)) / rate
+    gap = np.zeros(int(rate * gap_seconds))
+    parts = [gap]
+    for _ in range(bursts):
+        burst = sum(np.sin(2 * np.pi * f * t) for f in rng.uniform(250, 3000, size=4)) + rng.normal(0, 0.3, t.size)
+        parts += [0.2 * burst * np.hanning(t.size) * 32767 / 4, gap]
+    return np.concatenate(parts).astype(np.int16)
+
+
+class EnergySegmenter:
+    """
+    Splits audio into voiced segments by frame energy, this is how the fake transcription service finds "words".
+    """
+
+    def __init__(self, sample_rate, frame_ms=20, threshold_dbfs=-40, min_silence_ms=300):
+        self.sample_rate = sample_rate
+        self.frame = sample_rate * frame_ms // 1000
+        self.threshold_dbfs = threshold_dbfs
+        self.min_silence_frames = min_silence_ms // frame_ms
+        self.pending = np.zeros(0, dtype=np.int16)
+        self.frames = 0
+        self.start = None
+        self.silent_frames = 0
+
+    def _seconds(self, frames):
+        return frames * self.frame / self.sample_rate
+
+    def feed(self, samples):
+        """
+        This function adds audio to the segmenter.
+        :param samples: The next int16 samples.
+        :return: A list of the (start, end) times, in seconds, of the segments that were closed by this audio.
+        """
+        self.pending = np.concatenate((self.pending, samples))
+        usable = len(self.pending) // self.frame * self.frame
+        frames = self.pending[:usable].reshape(-1, self.frame).astype(np.float32)
+        self.pending = self.pending[usable:]
+        levels = 20 * np.log10(np.maximum(np.sqrt(np.mean(frames * frames, axis=1)), 1.0) / 32768)
+        closed = []
+        for level in levels:
+            if level > self.threshold_dbfs:
+                if self.start is None:
+                    self.start = self.frames
+                self.silent_frames = 0
+            elif self.start is not None:
+                self.silent_frames += 1
+                if self.silent_frames >= self.min_silence_frames:
+                    closed.append((self._seconds(self.start), self._seconds(self.frames - self.silent_frames + 1)))
+                    self.start = None
+            self.frames += 1
+        return closed
+
+    def open_segment(self):
+        """
+        :return: The (start, current end) times of the segment that is still being spoken, or None.
+        """
+        if self.start is None:
+            return None
+        return self._seconds(self.start), self._seconds(self.frames - self.silent_frames)
+
+    def flush(self):
+        """
+        :return: A list with the segment that was still open when the audio ended, if any.
+        """
+        segment = self.open_segment()
+        self.start = None
+        return [segment] if segment else []
+
+
+class FakeAudioStream:
+    """
+    The input side of a fake transcription stream, it has the same methods as the Transcribe audio stream.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.events = 0
+        self.bytes = 0
+
+    async def send_audio_event(self, audio_chunk):
+        self.events += 1
+        self.bytes += len(audio_chunk)
+        await self.queue.put(audio_chunk)
+
+    async def end_stream(self):
+        await self.queue.put(None)
+
+
+class FakeTranscriptResultStream:
+    """
+    The output side of a fake transcription stream. Every voiced segment of the received audio becomes one final result,
+    whose text is the next phrase of the script, with partial results while the segment is being spoken.
+    """
+
+    def __init__(self, audio_stream, sample_rate, phrases, latency):
+        self.audio_stream = audio_stream
+        self.segmenter = EnergySegmenter(sample_rate)
+        self.phrases = list(phrases)
+        self.latency = latency
+        self.segments = 0
+
+    def _event(self, start, end, is_partial):
+        text = self.phrases[self.segments] if self.segments < len(self.phrases) else f"phrase {self.segments + 1}"
+        if is_partial:
+            # the partial result grows by a word for every fifth of a second of speech
+            words = text.split()
+            text = " ".join(words[:min(len(words), int((end - start) / 0.2) + 1)])
+        result = Result(result_id=str(self.segments), start_time=start, end_time=end, is_partial=is_partial,
+                        alternatives=[Alternative(text, [])])
+        return TranscriptEvent(Transcript([result]))
+
+    async def __aiter__(self):
+        while True:
+            chunk = await self.audio_stream.queue.get()
+            segments = self.segmenter.flush() if chunk is None else \
+                self.segmenter.feed(np.frombuffer(chunk, dtype=np.int16))
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            for start, end in segments:
+                yield self._event(start, end, is_partial=False)
+                self.segments += 1
+            if chunk is None:
+                return
+            if self.segmenter.open_segment():
+                yield self._event(*self.segmenter.open_segment(), is_partial=True)
+
+
+class FakeTranscriptionStream:
+    def __init__(self, sample_rate, phrases, latency):
+        self.input_stream = FakeAudioStream()
+        self.output_stream = FakeTranscriptResultStream(self.input_stream, sample_rate, phrases, latency)
+
+
+class FakeTranscribeStreamingClient:
+    """
+    A stand-in for the TranscribeStreamingClient of amazon-transcribe, that transcribes a script instead of real speech.
+    """
+
+    def __init__(self, region=None, phrases=(), latency=0.0):
+        self.phrases = phrases
+        self.latency = latency
+
+    async def start_stream_transcription(self, *, language_code, media_sample_rate_hz, media_encoding, **kwargs):
+        if media_encoding != "pcm":
+            raise ValueError("The fake transcription service only supports pcm audio")
+        return FakeTranscriptionStream(media_sample_rate_hz, self.phrases, self.latency)
+
+
+class ResultCollector(TranscriptResultStreamHandler):
+    def __init__(self, transcript_result_stream):
+        super().__init__(transcript_result_stream)
+        self.results = []
+
+    async def handle_transcript_event(self, transcript_event):
+        for result in transcript_event.transcript.results:
+            if not result.is_partial:
+                self.results.append((result.alternatives[0].transcript, result.start_time, result.end_time))
+
+
+async def transcribe_chunks(client, chunks, sample_rate):
+    """
+    This function sends audio chunks through a (fake) transcription stream and collects the final results.
+    :param client: The transcription client.
+    :param chunks: An iterable of audio chunks as bytes.
+    :param sample_rate: The sample rate of the chunks.
+    :return: A tuple of the final results (text, start time, end time) and the input stream, for its statistics.
+    """
+    stream = await client.start_stream_transcription(language_code="en-US", media_sample_rate_hz=sample_rate,
+                                                     media_encoding="pcm")
+    collector = ResultCollector(stream.output_stream)
+
+    async def write():
+        for chunk in chunks:
+            await stream.input_stream.send_audio_event(audio_chunk=chunk)
+        await stream.input_stream.end_stream()
+    await asyncio.gather(write(), collector.handle_events())
+    return collector.results, stream.input_stream
+
+
+# a silent MPEG-2 layer III frame, mono at 24 kHz and 48 kbps like Polly's neural mp3: 144 bytes playing 24 ms
+SILENT_MP3_FRAME = bytes([0xFF, 0xF3, 0x64, 0xC0]) + bytes(140)
+
+
+class StubPollyClient:
+    """
+    A stand-in for the Amazon Polly client. It returns silent mp3 audio as long as the text would take to read out
+    loud, after a configurable latency, and counts its requests so caching can be checked.
+    """
+
+    def __init__(self, latency=0.1, chars_per_second=15):
+        self.latency = latency
+        self.chars_per_second = chars_per_second
+        self.requests = 0
+        self.characters = 0
+        self.lock = threading.Lock()
+
+    def synthesize_speech(self, Text, OutputFormat, VoiceId, Engine=None, **kwargs):
+        if OutputFormat != "mp3":
+            raise ValueError("The Polly stub only supports mp3")
+        with self.lock:
+            self.requests += 1
+            self.characters += len(Text)
+        time.sleep(self.latency)
+        frames = max(1, int(len(Text) / self.chars_per_second / 0.024))
+        return {"AudioStream": io.BytesIO(SILENT_MP3_FRAME * frames), "ContentType": "audio/mpeg",
+                "RequestCharacters": len(Text)}
+
+
+# the answers the Bedrock stand-in picks from, by the hash of the prompt
+CANNED_ANSWERS = (
+    "The answer depends on a few factors. First, consider the context of the question. Second, weigh the most likely "
+    "explanation against the alternatives. In most cases the simplest explanation is the right one.",
+    "Here is a short overview. The topic has a long history, and the main ideas are still in use today. It is worth "
+    "reading a good introduction before going into the details.",
+    "Yes, that is correct. There are some exceptions, but they are rare in practice. If you want to be sure, check "
+    "the official documentation for your situation.",
+)
+
+
+class FakeBedrockRuntime:
+    """
+    A stand-in for the bedrock-runtime client. It answers every prompt with a canned answer (or the given one), after a
+    configurable time to first token, streaming the answer at a configurable number of tokens per second.
+    """
+
+    def __init__(self, latency=0.3, tokens_per_second=80, answers=CANNED_ANSWERS):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.answers = answers
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def _answer(self, body):
+        with self.lock:
+            self.requests += 1
+        text = json.loads(body)["messages"][0]["content"][0]["text"]
+        answer = self.answers[int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16) % len(self.answers)]
+        # about 1.3 tokens per word, like the estimate in prompt_budget.py
+        return answer, int(len(text.split()) * 1.3), int(len(answer.split()) * 1.3)
+
+    def invoke_model(self, body, modelId, accept="application/json", contentType="application/json", **kwargs):
+        answer, input_tokens, output_tokens = self._answer(body)
+        time.sleep(self.latency + output_tokens / self.tokens_per_second)
+        response = {"id": "stub", "type": "message", "role": "assistant", "model": modelId,
+                    "content": [{"type": "text", "text": answer}], "stop_reason": "end_turn",
+                    "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens}}
+        return {"body": io.BytesIO(json.dumps(response).encode("utf-8")), "contentType": "application/json"}
+
+    def invoke_model_with_response_stream(self, body, modelId, accept="application/json",
+                                          contentType="application/json", **kwargs):
+        answer, input_tokens, output_tokens = self._answer(body)
+
+        def event(chunk):
+            return {"chunk": {"bytes": json.dumps(chunk).encode("utf-8")}}
+
+        def events():
+            yield event({"type": "message_start", "message": {"usage": {"input_tokens": input_tokens}}})
+            time.sleep(self.latency)
+            # streaming the answer word by word
+            for word in answer.split(" "):
+                time.sleep(1.3 / self.tokens_per_second)
+                yield event({"type": "content_block_delta", "delta": {"type": "text_delta", "text": word + " "}})
+            yield event({"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                         "usage": {"output_tokens": output_tokens}})
+            yield event({"type": "message_stop"})
+        return {"body": events(), "contentType": "application/json"}
+
+
+async def replay_chunks(chunks, interval=0.0):
+    """
+    This function plays audio chunks back like the microphone stream of live_transcription.py.
+    :param chunks: The audio chunks as bytes.
+    :param interval: The time between chunks, in seconds, 0 to replay as fast as possible.
+    :return: An asynchronous generator of (chunk, status) tuples.
+    """
+    for chunk in chunks:
+        await asyncio.sleep(interval)
+        yield chunk, None
+
+
+def capture_chunks(samples, capture_rate, transcribe_rate, block_frames=2048, chunk_ms=100):
+    """
+    This function runs a recording through the capture pipeline, block by block as the microphone would deliver it.
+    :param samples: The int16 samples at the capture rate.
+    :param capture_rate: The sample rate of the recording.
+    :param transcribe_rate: The sample rate sent to Transcribe.
+    :param block_frames: The number of frames per microphone block.
+    :param chunk_ms: The length of the chunks sent to Transcribe.
+    :return: A list of the chunks as bytes.
+    """
+    pipeline = CapturePipeline(capture_rate, transcribe_rate, chunk_ms)
+    chunks = []
+    for start in range(0, len(samples), block_frames):
+        pipeline.push(samples[start:start + block_frames].tobytes())
+        chunk = pipeline.pop()
+        while chunk is not None:
+            chunks.append(chunk)
+            chunk = pipeline.pop()
+    chunk = pipeline.pop(flush=True)
+    while chunk is not None:
+        chunks.append(chunk)
+        chunk = pipeline.pop(flush=True)
+    return chunks
+
+
+def verify_capture(samples, capture_rate, phrases=(), transcribe_rate=16000, block_frames=2048, tolerance=0.06):
+    """
+    This function checks that the resampled capture pipeline gives the same transcript as sending the raw microphone
+    blocks, and reports how much less audio is sent.
+    :param samples: The int16 samples of the recording.
+    :param capture_rate: The sample rate of the recording.
+    :param phrases: The script the fake transcription service reads out for the voiced segments.
+    :param transcribe_rate: The sample rate sent to Transcribe by the capture pipeline.
+    :param block_frames: The number of frames per microphone block.
+    :param tolerance: The maximum difference in segment start and end times, in seconds.
+    :return: A dictionary with the results of both paths, whether they match, and the bytes and events sent.
+    """
+    raw_blocks = [samples[start:start + block_frames].tobytes() for start in range(0, len(samples), block_frames)]
+    raw, raw_stream = asyncio.run(transcribe_chunks(FakeTranscribeStreamingClient(phrases=phrases), raw_blocks,
+                                                    capture_rate))
+    captured, captured_stream = asyncio.run(transcribe_chunks(
+        FakeTranscribeStreamingClient(phrases=phrases),
+        capture_chunks(samples, capture_rate, transcribe_rate, block_frames), transcribe_rate))
+    matches = len(raw) == len(captured) and all(
+        a[0] == b[0] and abs(a[1] - b[1]) <= tolerance and abs(a[2] - b[2]) <= tolerance
+        for a, b in zip(raw, captured))
+    return {
+        "matches": matches,
+        "raw": raw,
+        "captured": captured,
+        "raw_bytes": raw_stream.bytes,
+        "captured_bytes": captured_stream.bytes,
+        "raw_events": raw_stream.events,
+        "captured_events": captured_stream.events,
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "verify-capture":
+        print(__doc__)
+        sys.exit(2)
+    arguments = sys.argv[2:]
+    if arguments and arguments[0].endswith(".wav"):
+        recording, rate = read_wav(arguments.pop(0))
+    else:
+        recording, rate = synthetic_speech(), 48000
+    report = verify_capture(recording, rate, phrases=arguments)
+    for name in ("raw", "captured"):
+        print(f"{name}: {report[name]}")
+    print(f"bytes sent: {report['raw_bytes']} -> {report['captured_bytes']}, "
+          f"audio events: {report['raw_events']} -> {report['captured_events']}")
+    print("Transcripts match" if report["matches"] else "Transcripts do not match")
+    sys.exit(0 if report["matches"] else 1)
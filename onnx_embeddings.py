@@ -0,0 +1,281 @@
+"""
+A lightweight embedding backend for the CPU-only hosts: all-MiniLM-L6-v2 exported to ONNX, with its weights quantized to
+int8, and run with onnxruntime and the Rust tokenizers instead of the PyTorch stack. Set embedding_backend=onnx in the
+.env file to use it.
+
+Export and quantize the model once (this step needs torch and sentence-transformers, the app does not):
+
+    python onnx_embeddings.py export [--output-dir models/all-MiniLM-L6-v2-onnx]
+
+Check that the quantized model selects the same top-3 sample prompts as the PyTorch model, and compare their speed and
+memory:
+
+    python onnx_embeddings.py check [--queries questions.jsonl]
+
+The backend is experimental until the check has passed on the host that runs the app, its result is stored next to the
+model and the app logs a warning while there is no passing result.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from example_index import MODEL_NAME
+
+# the directory the exported model, its tokenizer and its settings are stored in
+ONNX_MODEL_DIR = "models/all-MiniLM-L6-v2-onnx"
+# the exported model before and after the int8 quantization of its weights
+FP32_MODEL_FILE = "model.onnx"
+INT8_MODEL_FILE = "model.int8.onnx"
+# the example index built with this backend is keyed by this name, so its vectors never mix with the PyTorch ones
+INDEX_MODEL_NAME = f"{MODEL_NAME}:onnx-int8"
+# the number of texts that are run through the model together by embed_documents()
+DOCUMENT_BATCH_SIZE = 32
+# the result of the last check, stored next to the model
+CHECK_FILE = "check.json"
+
+
+class OnnxEmbeddings:
+    """
+    Embeds texts with the quantized ONNX export of the sentence transformer: the tokens are run through the model, mean
+    pooled over the attention mask and normalized, like the sentence-transformers pipeline of all-MiniLM-L6-v2. It has the
+    embed_query and embed_documents methods of the langchain embeddings, and keeps the most recent query embeddings in an
+    LRU cache, since the same question is often embedded more than once.
+    """
+
+    def __init__(self, model_dir=ONNX_MODEL_DIR, threads=1, cache_size=1024, quantized=True):
+        # onnxruntime and tokenizers are only imported when this backend is used
+        import onnxruntime
+        from tokenizers import Tokenizer
+        model_path = os.path.join(model_dir, INT8_MODEL_FILE if quantized else FP32_MODEL_FILE)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"No ONNX model at {model_path}, run python onnx_embeddings.py export first")
+        with open(os.path.join(model_dir, "settings.json"), "r") as settings_file:
+            settings = json.load(settings_file)
+        options = onnxruntime.SessionOptions()
+        # the threads one query is spread over, the request pipeline already runs several queries in parallel
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=settings["max_length"])
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id("[PAD]"), pad_token="[PAD]")
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _embed(self, texts):
+        """
+        This function runs one batch of texts through the model.
+        :param texts: A list of texts.
+        :return: A float32 matrix with one normalized embedding row per text.
+        """
+        encodings = self.tokenizer.encode_batch(texts)
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+        # averaging the token embeddings, leaving out the padding
+        mask = inputs["attention_mask"][:, :, None].astype(np.float32)
+        vectors = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def embed_documents(self, texts):
+        """
+        This function embeds many texts, in batches of similar length so little time is spent on padding.
+        :param texts: A list of texts.
+        :return: A list with the embedding of every text, as a list of floats.
+        """
+        vectors = [None] * len(texts)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), DOCUMENT_BATCH_SIZE):
+            rows = order[start:start + DOCUMENT_BATCH_SIZE]
+            for row, vector in zip(rows, self._embed([texts[row] for row in rows])):
+                vectors[row] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text):
+        """
+        This function embeds a single question, or returns its embedding from the cache if it was embedded recently.
+        :param text: The question.
+        :return: The embedding as a list of floats.
+        """
+        with self.lock:
+            vector = self.cache.get(text)
+            if vector is not None:
+                self.cache.move_to_end(text)
+                self.hits += 1
+                return list(vector)
+            self.misses += 1
+        vector = self._embed([text])[0].tolist()
+        with self.lock:
+            self.cache[text] = vector
+            # dropping the least recently used embeddings once the cache is full
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return list(vector)
+
+    def cache_stats(self):
+        """
+        :return: A dictionary with the size, hits and misses of the query cache.
+        """
+        with self.lock:
+            return {"size": len(self.cache), "hits": self.hits, "misses": self.misses}
+
+
+def export(model_name=MODEL_NAME, output_dir=ONNX_MODEL_DIR):
+    """
+    This function exports the sentence transformer to ONNX and quantizes its weights to int8 (dynamic quantization, the
+    activations are quantized at run time). The tokenizer and the maximum sequence length are stored next to the model.
+    :param model_name: The name of the sentence-transformers model.
+    :param output_dir: The directory the model is written to.
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    class TokenEmbeddings(torch.nn.Module):
+        # the transformer without the pooling, returning only the token embeddings
+        def __init__(self, transformer):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.transformer(input_ids=input_ids, attention_mask=attention_mask,
+                                    token_type_ids=token_type_ids)[0]
+
+    model = SentenceTransformer(model_name, device="cpu")
+    os.makedirs(output_dir, exist_ok=True)
+    fp32_path = os.path.join(output_dir, FP32_MODEL_FILE)
+    int8_path = os.path.join(output_dir, INT8_MODEL_FILE)
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    sample = model.tokenizer(["An example question to trace the model with."], return_tensors="pt")
+    with torch.no_grad():
+        torch.onnx.export(TokenEmbeddings(model[0].auto_model).eval(), tuple(sample[name] for name in names),
+                          fp32_path, input_names=names, output_names=["token_embeddings"],
+                          dynamic_axes={name: {0: "batch", 1: "sequence"} for name in names + ["token_embeddings"]},
+                          opset_version=14)
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    model.tokenizer.backend_tokenizer.save(os.path.join(output_dir, "tokenizer.json"))
+    with open(os.path.join(output_dir, "settings.json"), "w") as settings_file:
+        json.dump({"model_name": model_name, "max_length": model.max_seq_length}, settings_file, indent=2)
+    print(f"Exported {model_name} to {int8_path} ({os.path.getsize(int8_path) / 1e6:.1f} MB, "
+          f"{os.path.getsize(fp32_path) / 1e6:.1f} MB before quantization)")
+
+
+def _peak_rss_mb():
+    # resource only exists on Unix, it is imported here so the app still imports this module on Windows
+    import resource
+    # the peak resident set size of this process, ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _measure(load, texts, queries):
+    """
+    This function loads an embedding backend, embeds the sample prompts and times the query embeddings one by one.
+    :return: A tuple of the example matrix, the query matrix and a dictionary of the timings and memory.
+    """
+    rss = _peak_rss_mb()
+    start = time.perf_counter()
+    embeddings = load()
+    load_seconds = time.perf_counter() - start
+    examples = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    latencies = []
+    vectors = []
+    for query in queries:
+        start = time.perf_counter()
+        vectors.append(embeddings.embed_query(query))
+        latencies.append(time.perf_counter() - start)
+    stats = {"load_seconds": load_seconds, "query_p50_ms": float(np.percentile(latencies, 50)) * 1000,
+             "query_p95_ms": float(np.percentile(latencies, 95)) * 1000, "rss_growth_mb": _peak_rss_mb() - rss}
+    return examples, np.asarray(vectors, dtype=np.float32), stats
+
+
+def check(queries=None, model_dir=ONNX_MODEL_DIR, threads=1, k=3):
+    """
+    This function checks that the quantized ONNX model selects the same top-k sample prompts as the PyTorch model. Each
+    backend embeds the sample prompts and the queries itself, like the app does with an index built by that backend.
+    :param queries: The questions to check, the inputs of the sample prompts by default.
+    :param model_dir: The directory of the exported model.
+    :param threads: The intra-op threads of onnxruntime.
+    :param k: The number of selected examples that have to match.
+    :return: The fraction of queries whose top-k examples are the same, in the same order.
+    """
+    import yaml
+    from example_index import example_to_text, SAMPLES_PATH
+    from retrieval import create_backend
+    with open(SAMPLES_PATH, "r") as stream:
+        samples = yaml.safe_load(stream)
+    texts = [example_to_text(sample) for sample in samples]
+    queries = queries or [sample["input"] for sample in samples]
+    # the ONNX backend is measured first, so the peak memory of PyTorch does not hide its growth
+    onnx_examples, onnx_queries, onnx_stats = _measure(lambda: OnnxEmbeddings(model_dir, threads), texts, queries)
+
+    def load_torch():
+        from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+        return HuggingFaceEmbeddings(model_name=MODEL_NAME)
+    torch_examples, torch_queries, torch_stats = _measure(load_torch, texts, queries)
+    torch_top, _ = create_backend("exact", torch_examples).search(torch_queries, k)
+    onnx_top, _ = create_backend("exact", onnx_examples).search(onnx_queries, k)
+    same_order = float(np.mean((torch_top == onnx_top).all(axis=1)))
+    same_set = float(np.mean([set(a) == set(b) for a, b in zip(torch_top, onnx_top)]))
+    same_first = float(np.mean(torch_top[:, 0] == onnx_top[:, 0]))
+    print(f"{len(queries)} queries over {len(samples)} sample prompts, top-{k}:")
+    print(f"  same examples in the same order: {same_order:.1%}")
+    print(f"  same examples in any order:      {same_set:.1%}")
+    print(f"  same most similar example:       {same_first:.1%}")
+    for name, stats in (("pytorch", torch_stats), ("onnx int8", onnx_stats)):
+        print(f"  {name:<10} load {stats['load_seconds']:.2f} s, query p50 {stats['query_p50_ms']:.1f} ms, "
+              f"p95 {stats['query_p95_ms']:.1f} ms, peak RSS growth {stats['rss_growth_mb']:.0f} MB")
+    return same_order
+
+
+def check_passed(model_dir=ONNX_MODEL_DIR):
+    """
+    This function reads the result of the last check of an exported model.
+    :param model_dir: The directory of the exported model.
+    :return: True if the last check passed, False if it failed or was never run.
+    """
+    try:
+        with open(os.path.join(model_dir, CHECK_FILE), "r") as check_file:
+            return bool(json.load(check_file)["passed"])
+    except (FileNotFoundError, KeyError, ValueError):
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and check the int8 ONNX embedding model.")
+    parser.add_argument("command", choices=["export", "check"])
+    parser.add_argument("--output-dir", default=ONNX_MODEL_DIR, help="the directory of the exported model")
+    parser.add_argument("--threads", type=int, default=1, help="intra-op threads of onnxruntime")
+    parser.add_argument("--queries", help="a JSONL file with the questions to check, in the question field")
+    parser.add_argument("--min-match", type=float, default=0.95,
+                        help="the fraction of queries whose top-3 has to match for the check to pass")
+    args = parser.parse_args()
+    if args.command == "export":
+        export(output_dir=args.output_dir)
+        return 0
+    queries = None
+    if args.queries:
+        with open(args.queries, "r") as questions:
+            queries = [json.loads(line)["question"] for line in questions if line.strip()]
+    same_order = check(queries, args.output_dir, args.threads)
+    passed = same_order >= args.min_match
+    with open(os.path.join(args.output_dir, CHECK_FILE), "w") as check_file:
+        json.dump({"same_order": same_order, "min_match": args.min_match, "queries": args.queries or "samples",
+                   "passed": passed, "checked_at": time.time()}, check_file, indent=2)
+    print(f"Check {'passed' if passed else 'failed'}, the result is stored in {args.output_dir}/{CHECK_FILE}")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
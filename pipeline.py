@@ -0,0 +1,207 @@
+import asyncio
+import contextvars
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# marks the end of a streamed stage, and carries the exception if the stage failed
+_DONE = object()
+
+
+class Overloaded(Exception):
+    """
+    Raised when a stage cannot accept more work within its timeout, or a user has too many requests in flight.
+    """
+
+
+class Stage:
+    """
+    A bounded worker pool for one stage of answering a question (embedding, LLM or TTS), shared by all sessions. At
+    most `workers` calls run at the same time and at most `max_queue` more wait for a worker. Callers beyond that block
+    for up to `timeout` seconds (backpressure) and then get an Overloaded error.
+    """
+
+    def __init__(self, name, workers, max_queue, timeout=30.0):
+        self.name = name
+        self.workers = workers
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-stage")
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+        self.capacity = workers + max_queue
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def submit(self, function, *args, **kwargs):
+        """
+        This function queues a call on the stage, waiting for a free slot if the stage is at capacity.
+        :param function: The function to call on a worker thread.
+        :return: The future of the call.
+        """
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.rejected += 1
+            raise Overloaded(f"The {self.name} stage is at capacity ({self.capacity} requests)")
+        return self._start(function, *args, **kwargs)
+
+    def try_submit(self, function, *args, **kwargs):
+        """
+        This function queues a call on the stage only if there is a free slot right away, for optional work that should
+        never wait, like speculative retrieval.
+        :param function: The function to call on a worker thread.
+        :return: The future of the call, or None if the stage is at capacity.
+        """
+        if not self.slots.acquire(blocking=False):
+            return None
+        return self._start(function, *args, **kwargs)
+
+    def _start(self, function, *args, **kwargs):
+        # the caller holds a slot, it is released once the call is done
+        with self.lock:
+            self.in_flight += 1
+        try:
+            # running the call in a copy of the callers context, so its spans belong to the callers trace
+            future = self.executor.submit(contextvars.copy_context().run, function, *args, **kwargs)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self.lock:
+            self.in_flight -= 1
+            self.completed += future is not None
+        self.slots.release()
+
+    def run(self, function, *args, **kwargs):
+        """
+        This function calls a function on the stage and waits for its result.
+        :param function: The function to call on a worker thread.
+        :return: The result of the function.
+        """
+        return self.submit(function, *args, **kwargs).result()
+
+    def stream(self, generator_function, *args, buffer=256, **kwargs):
+        """
+        This function runs a generator on the stage and yields its items in the calling thread as they are produced, for
+        example the tokens of an answer streamed back from Amazon Bedrock. The worker waits when the caller falls more
+        than `buffer` items behind, and stops when the caller stops iterating.
+        :param generator_function: The function that returns the generator.
+        :param buffer: The maximum number of items waiting for the caller.
+        :return: A generator of the items.
+        """
+        items = queue.Queue(maxsize=buffer)
+        cancelled = threading.Event()
+
+        def put(item):
+            while not cancelled.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for item in generator_function(*args, **kwargs):
+                    if not put(item):
+                        return
+                put((_DONE, None))
+            except Exception as e:
+                put((_DONE, e))
+
+        self.submit(produce)
+        try:
+            while True:
+                item = items.get()
+                if isinstance(item, tuple) and len(item) == 2 and item[0] is _DONE:
+                    if item[1] is not None:
+                        raise item[1]
+                    return
+                yield item
+        finally:
+            # releasing the worker if the caller stopped early, for example when streamlit reruns the script
+            cancelled.set()
+
+    def metrics(self):
+        """
+        :return: A dictionary with the workers, capacity, in flight, completed and rejected calls of the stage.
+        """
+        with self.lock:
+            return {"workers": self.workers, "capacity": self.capacity, "in_flight": self.in_flight,
+                    "completed": self.completed, "rejected": self.rejected}
+
+
+class UserLimiter:
+    """
+    Limits the number of requests a single user (session) can have in flight, so one user cannot fill the shared stages.
+    """
+
+    def __init__(self, max_in_flight=1):
+        self.max_in_flight = max_in_flight
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, user_id):
+        """
+        This function reserves one of the in flight requests of a user for the duration of the with block.
+        :param user_id: The id of the user or session.
+        """
+        with self.lock:
+            if self.counts.get(user_id, 0) >= self.max_in_flight:
+                raise Overloaded(f"Already {self.max_in_flight} request(s) in flight for this session")
+            self.counts[user_id] = self.counts.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.counts[user_id] -= 1
+                if not self.counts[user_id]:
+                    del self.counts[user_id]
+
+
+class RequestPipeline:
+    """
+    The stages every question goes through, shared by all sessions of the process, together with the per user limit.
+    """
+
+    def __init__(self, embedding_workers=4, llm_workers=16, tts_workers=4, max_queue=64, max_in_flight_per_user=1,
+                 timeout=30.0):
+        self.stages = {
+            "embedding": Stage("embedding", embedding_workers, max_queue, timeout),
+            "llm": Stage("llm", llm_workers, max_queue, timeout),
+            "tts": Stage("tts", tts_workers, max_queue, timeout),
+        }
+        self.users = UserLimiter(max_in_flight_per_user)
+
+    def submit(self, stage, function, *args, **kwargs):
+        return self.stages[stage].submit(function, *args, **kwargs)
+
+    def run(self, stage, function, *args, **kwargs):
+        return self.stages[stage].run(function, *args, **kwargs)
+
+    def stream(self, stage, generator_function, *args, **kwargs):
+        return self.stages[stage].stream(generator_function, *args, **kwargs)
+
+    def metrics(self):
+        """
+        :return: A dictionary of stage name to the metrics of the stage.
+        """
+        return {name: stage.metrics() for name, stage in self.stages.items()}
+
+
+class EventLoopThread:
+    """
+    A single asyncio event loop running in a background thread, shared by the transcription sessions of all users
+    instead of one loop and thread per user.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="event-loop", daemon=True)
+        self.thread.start()
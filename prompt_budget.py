@@ -0,0 +1,131 @@
+import logging
+import math
+import os
+import re
+from dataclasses import dataclass, field
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# loading in environment variables
+load_dotenv()
+
+# the maximum number of input tokens of the final prompt sent to Amazon Bedrock
+PROMPT_TOKEN_BUDGET = int(os.getenv('prompt_token_budget', 2000))
+# the answer of a retrieved example is truncated to this many tokens
+MAX_EXAMPLE_ANSWER_TOKENS = int(os.getenv('max_example_answer_tokens', 300))
+# the share of the budget (after the question) that the chat history may use, the rest goes to the examples
+HISTORY_SHARE = float(os.getenv('history_token_share', 0.4))
+
+# words and punctuation, Claude uses about 1.3 tokens per word of English text
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+TOKENS_PER_WORD = 1.3
+
+
+def estimate_tokens(text):
+    """
+    This function estimates the number of tokens of a text locally, without calling a tokenizer service.
+    :param text: The text to count.
+    :return: The estimated number of tokens.
+    """
+    if not text:
+        return 0
+    return math.ceil(len(TOKEN_PATTERN.findall(text)) * TOKENS_PER_WORD)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    This function shortens a text to about the given number of tokens, cutting it at a word boundary.
+    :param text: The text to shorten.
+    :param max_tokens: The maximum number of (estimated) tokens to keep.
+    :return: The text itself if it fits, otherwise the shortened text followed by "...".
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    words = list(TOKEN_PATTERN.finditer(text))
+    keep = max(1, int(max_tokens / TOKENS_PER_WORD))
+    return text[:words[keep - 1].end()] + " ..."
+
+
+def format_turn(turn):
+    """
+    This function formats a single question/answer of the chat history for the prompt.
+    :param turn: The Turn to format.
+    :return: The formatted question and answer.
+    """
+    return f"\n\nQuestion: {turn.question}\n\nAnswer: {turn.answer}"
+
+
+@dataclass
+class PromptPlan:
+    """
+    The parts of the prompt that fit the token budget, the estimated number of tokens of every part, and the turns of the
+    chat history that did not fit.
+    """
+    examples: list
+    history: str
+    breakdown: dict = field(default_factory=dict)
+    dropped_turns: list = field(default_factory=list)
+
+
+def fit_prompt(question, examples, turns, summary=None, budget=PROMPT_TOKEN_BUDGET, reserved_tokens=0,
+               max_answer_tokens=MAX_EXAMPLE_ANSWER_TOKENS, history_share=HISTORY_SHARE):
+    """
+    This function picks the examples and chat history that fit the token budget. The question always fits, the most
+    recent questions/answers come next, older ones are only represented by the rolling summary, and the examples are
+    added in order of similarity with their answers truncated.
+    :param question: The question of the user.
+    :param examples: The retrieved examples, most similar first.
+    :param turns: The turns of the chat history, oldest first.
+    :param summary: The rolling summary of the older turns, if there is one.
+    :param budget: The maximum number of input tokens of the prompt.
+    :param reserved_tokens: Tokens used by fixed instructions around the prompt.
+    :param max_answer_tokens: The maximum number of tokens of the answer of an example.
+    :param history_share: The share of the remaining budget that the chat history may use.
+    :return: A PromptPlan with the examples and the formatted chat history to use.
+    """
+    turns = list(turns)
+    breakdown = {"budget": budget, "instructions": reserved_tokens, "question": estimate_tokens(question)}
+    remaining = budget - reserved_tokens - breakdown["question"]
+    # the chat history: the summary of the older turns, then as many recent turns as fit, newest first
+    history_budget = int(max(remaining, 0) * history_share)
+    history_parts = []
+    summary_text = f"\n\nSummary of the earlier conversation: {summary}" if summary else ""
+    used = estimate_tokens(summary_text)
+    if used > history_budget:
+        summary_text, used = "", 0
+    kept_turns = 0
+    for turn in reversed(turns):
+        cost = estimate_tokens(format_turn(turn))
+        if used + cost > history_budget:
+            break
+        history_parts.insert(0, format_turn(turn))
+        used += cost
+        kept_turns += 1
+    history = summary_text + "".join(history_parts)
+    breakdown.update({"summary": estimate_tokens(summary_text), "history": used - estimate_tokens(summary_text),
+                      "history_turns": kept_turns, "dropped_turns": len(turns) - kept_turns})
+    remaining -= used
+    # the examples, most similar first, with long answers truncated and examples that do not fit dropped
+    selected = []
+    example_tokens = 0
+    for example in examples:
+        example = dict(example, answer=truncate_to_tokens(example["answer"], max_answer_tokens))
+        cost = estimate_tokens(example["input"]) + estimate_tokens(example["answer"])
+        if example_tokens + cost > remaining:
+            continue
+        selected.append(example)
+        example_tokens += cost
+    breakdown.update({"examples": example_tokens, "example_count": len(selected),
+                      "dropped_examples": len(examples) - len(selected)})
+    breakdown["total"] = breakdown["instructions"] + breakdown["question"] + used + example_tokens
+    # the oldest turns did not fit, they are only kept in the prompt once they are in the rolling summary
+    return PromptPlan(selected, history or None, breakdown, turns[:len(turns) - kept_turns])
+
+
+def log_breakdown(breakdown):
+    """
+    This function logs the estimated token breakdown of a prompt.
+    :param breakdown: The breakdown of a PromptPlan.
+    """
+    logger.info("Prompt tokens: %s", ", ".join(f"{key}={value}" for key, value in breakdown.items()))
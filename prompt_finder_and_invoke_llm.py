@@ -1,26 +1,18 @@
-import os
-from dotenv import load_dotenv
-import boto3
 import json
-import botocore.config
-import yaml
-from langchain.prompts.few_shot import FewShotPromptTemplate
-from langchain.prompts.prompt import PromptTemplate
-from langchain.embeddings.huggingface import HuggingFaceEmbeddings
-from langchain.prompts.example_selector.semantic_similarity import (
-    SemanticSimilarityExampleSelector,
-)
-from langchain_community.vectorstores import Chroma
-
-# loading in environment variables
-load_dotenv()
-
-# configuring our CLI profile name
-boto3.setup_default_session(profile_name=os.getenv('profile_name'))
-# increasing the timeout period when invoking bedrock
-config = botocore.config.Config(connect_timeout=120, read_timeout=120)
-# instantiating the bedrock client
-bedrock = boto3.client('bedrock-runtime', 'us-east-1', endpoint_url='https://bedrock-runtime.us-east-1.amazonaws.com', config=config)
+import time
+from chat_history_prompt_generator import RollingSummarizer
+from prompt_budget import estimate_tokens, fit_prompt, format_turn, log_breakdown
+from resources import get_bedrock, get_embeddings, get_example_selector, get_prompt_templates, get_samples
+from tracing import tracer
+
+# the Amazon Bedrock model that generates the answers
+MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+# the instruction that is wrapped around every prompt
+ANSWER_INSTRUCTION = "Answer the following prompt in less than 1500 characters. Don't include any preamble or state the " \
+                     "character limit:"
+# the instruction used to compress older questions/answers into the rolling summary of the chat history
+SUMMARY_INSTRUCTION = "Summarize the following conversation in less than 100 words, keeping names, facts and decisions " \
+                      "that a follow-up question could refer to. Only return the summary:"
 
 
 def load_samples():
@@ -28,85 +20,116 @@ def load_samples():
     Load the generic examples for few-shot prompting.
     :return: The generic samples from the generic_samples.yaml file
     """
-    # initializing the generic_samples variable, where we will store our samples once they are read in
-    generic_samples = None
-    # opening and reading the sample prompts file
-    with open("sample_prompts/generic_samples.yaml", "r") as stream:
-        # storing the sample files in the generic samples variable we initialized
-        generic_samples = yaml.safe_load(stream)
-    # returning the string containing all the sample prompts
-    return generic_samples
+    # the samples are read from the compiled index once per process and shared through the resource registry
+    return get_samples()
+
+
+def embed_question(question):
+    """
+    This function embeds the users question, the embedding is shared by the answer cache and the example search.
+    :param question: This is the question that is passed in through the streamlit frontend from the user.
+    :return: The embedding of the question.
+    """
+    with tracer.span("embedding", characters=len(question)):
+        return get_embeddings().embed_query(question)
 
 
-def chat_history_loader():
+def escape_braces(value):
     """
-    This function reads the chat_history.txt file, and puts it into a string to later inject into our prompt.
-    :return: A string containing all the chat history question and answers in a prompt format.
+    This function escapes the braces of a value of an example. The FewShotPromptTemplate joins the formatted examples and
+    formats them once more together with the suffix, so a sample answer with code or json in it would otherwise be read
+    as a template variable and fail with a KeyError.
+    :param value: The input or answer of an example.
+    :return: The value as a string, with every brace doubled.
     """
-    # opening the chat history txt file
-    with open("chat_history.txt", "r") as file:
-        # reading the contents of the chat_history.txt file and reading it into a string
-        chat_history = file.read()
-        # simple logic if there is no Chat History return None
-        if chat_history == "":
-            return None
-        # if there is Chat History, return it so it can be formatted in the final prompt
-        else:
-            return chat_history
+    return str(value).replace("{", "{{").replace("}", "}}")
 
 
-def prompt_finder(question):
+def build_prompt(question, memory=None, query_vector=None, examples=None):
     """
     This function performs a semantic search based on the users question against all the sample prompts stored in the
     sample_prompts/generic_samples.yaml file. It finds the three most relevant prompts and formats them into a single prompt
-    along with the users question.
+    along with the chat history and the users question, keeping the prompt within the token budget (see prompt_budget.py).
     :param question: This is the question that is passed in through the streamlit frontend from the user.
+    :param memory: The ConversationMemory of the session, containing the previous questions and answers.
+    :param query_vector: The embedding of the question, if it was already computed by embed_question().
+    :param examples: The most similar sample prompts, if they were already selected (see speculative_retrieval.py).
     :return: This function returns a final prompt that contains three semantically similar prompts, the chat history if
     there is any and the users question all formatted in a single prompt ready to be passed into Amazon Bedrock.
     """
-    # loading the sample prompts from sample_prompts/generic_samples.yaml
-    examples = load_samples()
-    # instantiating the hugging face embeddings model to be used to produce embeddings of user queries and prompts
-    local_embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    # The example selector loads the examples, creates the embeddings, stores them in Chroma (vector store) and a
-    # semantic search is performed to see the similarity between the question and prompts, it returns the 3 most similar
-    # prompts as defined by k
-    example_selector = SemanticSimilarityExampleSelector.from_examples(
-        # This is the list of examples available to select from.
-        examples,
-        # This is the embedding class used to produce embeddings which are used to measure semantic similarity.
-        local_embeddings,
-        # This is the VectorStore class that is used to store the embeddings and do a similarity search over.
-        Chroma,
-        # This is the number of examples to produce.
-        # TODO: Can change this number to determine how many prompts you want to retrieve
-        k=3
-    )
-    # This is formatting the prompts that are retrieved from the sample_prompts/generic_samples.yaml file
-    example_prompt = PromptTemplate(input_variables=["input", "answer"], template="\n\nHuman: {input} \n\nAssistant: "
-                                                                                  "{answer}")
-    # This is orchestrating the example selector (finding similar prompts to the question), example_prompt (formatting
-    # the retrieved prompts, and formatting the chat history and the user input
-    prompt = FewShotPromptTemplate(
-        example_selector=example_selector,
-        example_prompt=example_prompt,
-        suffix=f"Chat History: {chat_history_loader()}\n\n" + "Human: {input}\n\nAssistant:",
-        input_variables=["input"]
-    )
-    # This is calling the prompt method and passing in the users question to create the final multi-shot prompt,
-    # with the semantically similar prompts, and chat history
-    question_with_prompt = prompt.format(input=question)
+    # The example selector is created once per process (see resources.py). It searches the prebuilt example index, which
+    # holds the embeddings of all sample prompts, only the users question is embedded and a semantic search is performed
+    # to see the similarity between the question and prompts, it returns the 3 most similar prompts
+    if examples is None:
+        if query_vector is None:
+            query_vector = embed_question(question)
+        examples = get_example_selector().select_examples_by_vector(query_vector)
+    # the langchain prompt classes are imported on first use (see resources.py)
+    FewShotPromptTemplate, PromptTemplate = get_prompt_templates()
+    # assembling the prompt is timed as its own stage
+    with tracer.span("prompt_format") as span:
+        # picking the examples and chat history that fit the token budget, long example answers are truncated and older
+        # questions/answers are only represented by the rolling summary
+        plan = fit_prompt(question, examples, list(memory) if memory is not None else [],
+                          memory.summary if memory is not None else None,
+                          reserved_tokens=estimate_tokens(ANSWER_INSTRUCTION))
+        log_breakdown(plan.breakdown)
+        # the turns that did not fit are summarized in the background, so the next prompts still cover them
+        if plan.dropped_turns and memory is not None:
+            memory.summarize_dropped(plan.dropped_turns)
+        # This is formatting the prompts that are retrieved from the sample_prompts/generic_samples.yaml file
+        example_prompt = PromptTemplate(input_variables=["input", "answer"], template="\n\nHuman: {input} "
+                                                                                      "\n\nAssistant: {answer}")
+        # This is orchestrating the selected examples, example_prompt (formatting the retrieved prompts, and formatting
+        # the chat history and the user input
+        prompt = FewShotPromptTemplate(
+            examples=[{key: escape_braces(value) for key, value in example.items()} for example in plan.examples],
+            example_prompt=example_prompt,
+            suffix="Chat History: {history}\n\nHuman: {input}\n\nAssistant:",
+            input_variables=["input", "history"]
+        )
+        # This is calling the prompt method and passing in the users question to create the final multi-shot prompt,
+        # with the semantically similar prompts, and chat history
+        question_with_prompt = prompt.format(input=question, history=plan.history)
+        span.set(prompt_tokens=plan.breakdown["total"], prompt_characters=len(question_with_prompt),
+                 examples=len(plan.examples))
     # we return the finalized prompt, ready to be passed into Amazon Bedrock to generate a response
-    return llm_answer_generator(question_with_prompt)
+    return question_with_prompt
 
 
-def llm_answer_generator(question_with_prompt):
+def prompt_finder(question, memory=None, query_vector=None, prompt=None):
     """
-    This function is used to invoke Amazon Bedrock using the finalized prompt that was created by the prompt_finder(question)
-    function.
+    This function builds the few-shot prompt for the users question and invokes Amazon Bedrock with it.
+    :param question: This is the question that is passed in through the streamlit frontend from the user.
+    :param memory: The ConversationMemory of the session, containing the previous questions and answers.
+    :param query_vector: The embedding of the question, if it was already computed by embed_question().
+    :param prompt: The few-shot prompt, if it was already assembled by build_prompt().
+    :return: The final answer to the users question.
+    """
+    # the prompt may already have been assembled while the user was still speaking
+    return llm_answer_generator(prompt or build_prompt(question, memory, query_vector))
+
+
+def prompt_finder_stream(question, memory=None, query_vector=None, prompt=None):
+    """
+    This function builds the few-shot prompt for the users question and streams the answer from Amazon Bedrock.
+    :param question: This is the question that is passed in through the streamlit frontend from the user.
+    :param memory: The ConversationMemory of the session, containing the previous questions and answers.
+    :param query_vector: The embedding of the question, if it was already computed by embed_question().
+    :param prompt: The few-shot prompt, if it was already assembled by build_prompt().
+    :return: A generator that yields the answer piece by piece as it is generated.
+    """
+    # the prompt may already have been assembled while the user was still speaking
+    return llm_answer_stream(prompt or build_prompt(question, memory, query_vector))
+
+
+def request_body(question_with_prompt, instruction=ANSWER_INSTRUCTION):
+    """
+    This function creates the body of the Amazon Bedrock request, it is shared by the blocking and streaming invocations.
     :param question_with_prompt: This is the finalized prompt that includes semantically similar prompts, chat history,
     and the users question all in a proper multi-shot format.
-    :return: The final answer to the users question.
+    :param instruction: The instruction that is wrapped around the prompt.
+    :return: The request body as a json string.
     """
     # body of data with parameters that is passed into the bedrock invoke model request
     # TODO: TUNE THESE PARAMETERS AS YOU SEE FIT
@@ -120,20 +143,81 @@ def llm_answer_generator(question_with_prompt):
                 "content": [
                     {
                         "type": "text",
-                        "text": "Answer the following prompt in less than 1500 characters. Don't include any preamble or state the character limit: <prompt> " + question_with_prompt + " <prompt>"
+                        "text": instruction + " <prompt> " + question_with_prompt + " <prompt>"
                     }
                 ]
             }
         ]
     }
     # formatting the prompt as a json string
-    json_prompt = json.dumps(prompt)
-    # invoking Claude3, passing in our prompt
-    response = bedrock.invoke_model(body=json_prompt, modelId="anthropic.claude-3-haiku-20240307-v1:0",
-                                    accept="application/json", contentType="application/json")
-    # getting the response from Claude3 and parsing it to return to the end user
-    response_body = json.loads(response.get('body').read())
+    return json.dumps(prompt)
+
+
+def llm_answer_generator(question_with_prompt, instruction=ANSWER_INSTRUCTION):
+    """
+    This function is used to invoke Amazon Bedrock using the finalized prompt that was created by the prompt_finder(question)
+    function.
+    :param question_with_prompt: This is the finalized prompt that includes semantically similar prompts, chat history,
+    and the users question all in a proper multi-shot format.
+    :param instruction: The instruction that is wrapped around the prompt.
+    :return: The final answer to the users question.
+    """
+    # creating the request body that is passed into the bedrock invoke model request
+    json_prompt = request_body(question_with_prompt, instruction)
+    with tracer.span("bedrock", request_bytes=len(json_prompt)) as span:
+        # invoking Claude3, passing in our prompt
+        response = get_bedrock().invoke_model(body=json_prompt, modelId=MODEL_ID,
+                                              accept="application/json", contentType="application/json")
+        # getting the response from Claude3 and parsing it to return to the end user
+        response_body = json.loads(response.get('body').read())
+        usage = response_body.get('usage', {})
+        span.set(input_tokens=usage.get('input_tokens', 0), output_tokens=usage.get('output_tokens', 0))
     # the final string returned to the end user
     answer = response_body['content'][0]['text']
     # returning the final string to the end user
     return answer
+
+
+def llm_answer_stream(question_with_prompt):
+    """
+    This function invokes Amazon Bedrock with a streaming response, so the answer can be shown and read out loud while it
+    is still being generated.
+    :param question_with_prompt: This is the finalized prompt that includes semantically similar prompts, chat history,
+    and the users question all in a proper multi-shot format.
+    :return: A generator that yields the answer piece by piece as it is generated.
+    """
+    json_prompt = request_body(question_with_prompt)
+    with tracer.span("bedrock_stream", request_bytes=len(json_prompt)) as span:
+        start = time.perf_counter()
+        # invoking Claude3 with the same request body, but streaming the response back
+        response = get_bedrock().invoke_model_with_response_stream(body=json_prompt, modelId=MODEL_ID,
+                                                                   accept="application/json",
+                                                                   contentType="application/json")
+        # every event in the stream is a json chunk, only the text deltas contain the answer
+        for event in response.get('body'):
+            chunk = json.loads(event['chunk']['bytes'])
+            if chunk['type'] == 'content_block_delta':
+                if "time_to_first_token" not in span.attributes:
+                    span.set(time_to_first_token=time.perf_counter() - start)
+                yield chunk['delta'].get('text', '')
+            # the token counts arrive at the start and the end of the stream
+            elif chunk['type'] == 'message_start':
+                span.set(input_tokens=chunk['message'].get('usage', {}).get('input_tokens', 0))
+            elif chunk['type'] == 'message_delta':
+                span.set(output_tokens=chunk.get('usage', {}).get('output_tokens', 0))
+
+
+def summarize_history(summary, turns):
+    """
+    This function compresses older questions/answers of the chat history into the rolling summary. It runs in the
+    background (see RollingSummarizer), never while a question is being answered.
+    :param summary: The current summary of the conversation, or None.
+    :param turns: The turns that are added to the summary, oldest first.
+    :return: The new summary.
+    """
+    conversation = (f"Summary so far: {summary}" if summary else "") + "".join(format_turn(turn) for turn in turns)
+    return llm_answer_generator(conversation, instruction=SUMMARY_INSTRUCTION)
+
+
+# the process-wide summarizer, it compresses the turns that fall out of the conversation memory of any session
+history_summarizer = RollingSummarizer(summarize_history)
@@ -0,0 +1,326 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+import boto3
+import botocore.config
+from dotenv import load_dotenv
+from answer_cache import SemanticAnswerCache, SQLiteAnswerStore
+from example_index import load_index, MODEL_NAME
+from onnx_embeddings import check_passed, INDEX_MODEL_NAME, ONNX_MODEL_DIR, OnnxEmbeddings
+from pipeline import EventLoopThread, RequestPipeline
+from retrieval import create_backend, ExampleRetriever
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# loading in environment variables
+load_dotenv()
+
+# configuring our CLI profile name, once per process instead of on every streamlit rerun
+boto3.setup_default_session(profile_name=os.getenv('profile_name'))
+# the size of the HTTP connection pool of every AWS client, so concurrent sessions do not wait for a connection
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('aws_max_pool_connections', 50))
+# the embedding backend: "torch" runs the sentence-transformers model, "onnx" its int8 ONNX export (see onnx_embeddings.py)
+EMBEDDING_BACKEND = os.getenv('embedding_backend', 'torch')
+
+# the registry of warm, process-wide resources, shared by every streamlit session and rerun
+_resources = {}
+# the readiness state of every resource: "cold", "warming", "ready" or "failed"
+_status = {}
+# how long each resource took to create, in seconds
+_load_seconds = {}
+# the error of every resource that failed to load
+_errors = {}
+# how long the explicit startup preloading took, in seconds
+_warm_up_seconds = None
+# the time-to-first-answer of the first answered question in the process, the cold start
+_cold_start_answer_seconds = None
+# the time-to-first-answer of the most recent later questions, the steady state
+_answer_seconds = deque(maxlen=int(os.getenv('answer_time_window', 1000)))
+_lock = threading.RLock()
+# one lock per resource, so loading a slow resource does not block the resources that are already loaded or independent
+_locks = {}
+
+
+def _get(name, factory):
+    """
+    This function returns the named resource, creating it the first time it is requested. All later callers, from any
+    session or thread, get the same object.
+    :param name: The name of the resource in the registry.
+    :param factory: A function without arguments that creates the resource.
+    :return: The warm resource.
+    """
+    if name in _resources:
+        return _resources[name]
+    with _lock:
+        lock = _locks.setdefault(name, threading.RLock())
+    with lock:
+        # another thread may have created the resource while we were waiting for the lock
+        if name not in _resources:
+            _status[name] = "warming"
+            start = time.perf_counter()
+            try:
+                with tracer.span(f"load_{name}"):
+                    _resources[name] = factory()
+            except Exception as e:
+                _status[name] = "failed"
+                _errors[name] = f"{type(e).__name__}: {e}"
+                raise
+            _load_seconds[name] = time.perf_counter() - start
+            _errors.pop(name, None)
+            _status[name] = "ready"
+        return _resources[name]
+
+
+def get_samples():
+    """
+    This function returns the sample prompts, read from the compiled index of the sample_prompts/generic_samples.yaml
+    file instead of parsing the yaml file.
+    :return: A sequence of the sample prompt dictionaries.
+    """
+    return _get("samples", lambda: get_index().examples)
+
+
+def get_embeddings():
+    """
+    This function returns the hugging face embeddings model used to embed the users questions.
+    :return: The shared HuggingFaceEmbeddings instance, or the OnnxEmbeddings instance if embedding_backend=onnx is set.
+    """
+    def load():
+        if EMBEDDING_BACKEND == 'onnx':
+            model_dir = os.getenv('onnx_model_dir', ONNX_MODEL_DIR)
+            # the quantized model may select other examples than the PyTorch one until the check proves otherwise
+            if not check_passed(model_dir):
+                logger.warning("The ONNX embedding model in %s has not passed python onnx_embeddings.py check on this "
+                               "host, the selected examples may differ from the PyTorch model", model_dir)
+            return OnnxEmbeddings(model_dir,
+                                  threads=int(os.getenv('onnx_intra_op_threads', 1)),
+                                  cache_size=int(os.getenv('embedding_cache_size', 1024)))
+        if EMBEDDING_BACKEND != 'torch':
+            raise ValueError(f"Unknown embedding backend: {EMBEDDING_BACKEND}, choose torch or onnx")
+        # langchain and torch take seconds to import, so they are only imported when the model is loaded
+        from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+        return HuggingFaceEmbeddings(model_name=MODEL_NAME)
+    return _get("embeddings", load)
+
+
+def get_index():
+    """
+    This function returns the compiled example index, building it first if the sample prompts changed. The embedding
+    model is only loaded for the build if examples have to be embedded. Every embedding backend has its own index, so the
+    examples and the questions are always embedded by the same model.
+    :return: The shared ExampleIndex.
+    """
+    model_name = INDEX_MODEL_NAME if EMBEDDING_BACKEND == 'onnx' else MODEL_NAME
+    return _get("index", lambda: load_index(get_embeddings, model_name=model_name))
+
+
+def get_prompt_templates():
+    """
+    This function returns the langchain prompt template classes, which are imported on first use instead of when the
+    app starts.
+    :return: A tuple of the FewShotPromptTemplate and PromptTemplate classes.
+    """
+    def load():
+        from langchain.prompts.few_shot import FewShotPromptTemplate
+        from langchain.prompts.prompt import PromptTemplate
+        return FewShotPromptTemplate, PromptTemplate
+    return _get("prompt_templates", load)
+
+
+def get_example_selector():
+    """
+    This function returns the example selector that finds the 3 most similar sample prompts for a question.
+    :return: The shared ExampleRetriever.
+    """
+    def load():
+        index = get_index()
+        # the exact search is the default, set retrieval_backend=hnsw in the .env file for very large example corpora
+        backend_name = os.getenv('retrieval_backend', 'exact')
+        options = {"precision": os.getenv('retrieval_precision', 'float32')} if backend_name == "exact" else {}
+        backend = create_backend(backend_name, index.vectors, **options)
+        # TODO: Can change k to determine how many prompts you want to retrieve
+        return ExampleRetriever(index.examples, backend, get_embeddings(), k=3)
+    return _get("example_selector", load)
+
+
+def get_bedrock():
+    """
+    This function returns the Amazon Bedrock runtime client.
+    :return: The shared bedrock-runtime client, or the local stand-in from local_stubs.py if llm_backend=stub is set.
+    """
+    def load():
+        if os.getenv('llm_backend') == 'stub':
+            from local_stubs import FakeBedrockRuntime
+            return FakeBedrockRuntime()
+        # increasing the timeout period when invoking bedrock
+        config = botocore.config.Config(connect_timeout=120, read_timeout=120,
+                                        max_pool_connections=AWS_MAX_POOL_CONNECTIONS)
+        return boto3.client('bedrock-runtime', 'us-east-1',
+                            endpoint_url='https://bedrock-runtime.us-east-1.amazonaws.com', config=config)
+    return _get("bedrock", load)
+
+
+def get_polly():
+    """
+    This function returns the Amazon Polly client.
+    :return: The shared polly client, or the local stand-in from local_stubs.py if tts_backend=stub is set.
+    """
+    def load():
+        if os.getenv('tts_backend') == 'stub':
+            from local_stubs import StubPollyClient
+            return StubPollyClient()
+        return boto3.client('polly', region_name='us-east-1',
+                            config=botocore.config.Config(max_pool_connections=AWS_MAX_POOL_CONNECTIONS))
+    return _get("polly", load)
+
+
+def get_answer_cache():
+    """
+    This function returns the semantic answer cache that is shared by all sessions. Set answer_cache_db in the .env file
+    to keep the cached answers on disk, so they survive restarts.
+    :return: The shared SemanticAnswerCache.
+    """
+    def load():
+        store = SQLiteAnswerStore(os.getenv('answer_cache_db')) if os.getenv('answer_cache_db') else None
+        return SemanticAnswerCache(threshold=float(os.getenv('answer_cache_threshold', 0.95)),
+                                   ttl_seconds=float(os.getenv('answer_cache_ttl_seconds', 86400)),
+                                   max_entries=int(os.getenv('answer_cache_max_entries', 1000)),
+                                   max_bytes=int(os.getenv('answer_cache_max_bytes', 64 * 1024 * 1024)),
+                                   store=store)
+    return _get("answer_cache", load)
+
+
+def get_pipeline():
+    """
+    This function returns the request pipeline that bounds the number of concurrent embedding, LLM and TTS calls of all
+    sessions, and the number of requests in flight per session.
+    :return: The shared RequestPipeline.
+    """
+    return _get("pipeline", lambda: RequestPipeline(
+        embedding_workers=int(os.getenv('embedding_workers', 4)),
+        llm_workers=int(os.getenv('llm_workers', 16)),
+        tts_workers=int(os.getenv('tts_workers', 4)),
+        max_queue=int(os.getenv('stage_max_queue', 64)),
+        max_in_flight_per_user=int(os.getenv('max_in_flight_per_user', 1)),
+        timeout=float(os.getenv('stage_timeout_seconds', 30))))
+
+
+def get_event_loop():
+    """
+    This function returns the event loop that runs the transcription sessions of all users.
+    :return: The shared asyncio event loop, running in a background thread.
+    """
+    return _get("event_loop", EventLoopThread).loop
+
+
+# the resources that are preloaded at startup, in the order they are created, the ones the page needs first are cheap
+# and come first
+WARM_UP = {
+    "pipeline": get_pipeline,
+    "event_loop": get_event_loop,
+    "answer_cache": get_answer_cache,
+    "bedrock": get_bedrock,
+    "polly": get_polly,
+    "index": get_index,
+    "samples": get_samples,
+    "embeddings": get_embeddings,
+    "prompt_templates": get_prompt_templates,
+    "example_selector": get_example_selector,
+}
+# the thread that runs the background warm up
+_warm_up_thread = None
+
+
+def warm():
+    """
+    This function creates every resource in the registry ahead of the first question, so the first user does not pay for
+    loading the models. Resources that are already warm are not created again. A resource that fails to load does not
+    stop the others, its error is reported by failures().
+    :return: A dictionary of resource name to the error of every resource that failed to load.
+    """
+    global _warm_up_seconds
+    start = time.perf_counter()
+    for name, getter in WARM_UP.items():
+        try:
+            getter()
+        except Exception:
+            logger.exception("Loading the %s resource failed", name)
+    # only the first complete warm up of the process is the cold start, later calls find every resource ready
+    if _warm_up_seconds is None and is_ready():
+        _warm_up_seconds = time.perf_counter() - start
+    return failures()
+
+
+def warm_in_background():
+    """
+    This function starts warm() in a background thread, so the page can be rendered while the models are loading. It
+    does nothing if the resources are ready or already warming, and tries again if a resource failed to load.
+    """
+    global _warm_up_thread
+    with _lock:
+        if is_ready() or is_warming():
+            return
+        _warm_up_thread = threading.Thread(target=warm, name="warm-up", daemon=True)
+        _warm_up_thread.start()
+
+
+def is_warming():
+    """
+    :return: True while the background warm up is running.
+    """
+    return _warm_up_thread is not None and _warm_up_thread.is_alive()
+
+
+def readiness():
+    """
+    This function reports the readiness state of every resource, so the frontend can show it.
+    :return: A dictionary of resource name to its state ("cold", "warming", "ready" or "failed").
+    """
+    return {name: _status.get(name, "cold") for name in WARM_UP}
+
+
+def failures():
+    """
+    :return: A dictionary of resource name to the error of every resource that failed to load.
+    """
+    return dict(_errors)
+
+
+def is_ready():
+    """
+    :return: True if every resource has been created.
+    """
+    return all(state == "ready" for state in readiness().values())
+
+
+def record_answer_time(seconds):
+    """
+    This function records the time-to-first-answer of a question.
+    :param seconds: The time between the question being submitted and its answer being shown.
+    """
+    global _cold_start_answer_seconds
+    with _lock:
+        if _cold_start_answer_seconds is None:
+            _cold_start_answer_seconds = seconds
+        else:
+            _answer_seconds.append(seconds)
+
+
+def timings():
+    """
+    This function reports the startup and answer timings of this process. The first answered question is reported as
+    the cold start, the most recent later ones (answer_time_window) as steady state.
+    :return: A dictionary with the warm up time, the load time of every resource, the cold start answer time and the median steady state answer time.
+    """
+    with _lock:
+        steady_state = sorted(_answer_seconds)
+        return {
+            "warm_up_seconds": _warm_up_seconds,
+            "load_seconds": dict(_load_seconds),
+            "cold_start_answer_seconds": _cold_start_answer_seconds,
+            "steady_state_answer_seconds": steady_state[len(steady_state) // 2] if steady_state else None,
+            "steady_state_answers": len(steady_state),
+        }
@@ -0,0 +1,172 @@
+import numpy as np
+from tracing import tracer
+
+# the number of matrix rows that are converted back to float32 at a time when searching a float16 or int8 matrix
+BLOCK_ROWS = 8192
+
+
+def normalize(vectors):
+    """
+    This function scales every row of a matrix to unit length, so a dot product between rows is the cosine similarity.
+    :param vectors: A matrix (or a single vector) of embeddings.
+    :return: A contiguous float32 matrix with unit length rows.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.ascontiguousarray(vectors / np.where(norms == 0, 1.0, norms))
+
+
+def _top_k(scores, k):
+    """
+    This function finds the k highest scores in every row of a score matrix, without sorting the full rows.
+    :param scores: A matrix of similarity scores, one row per query and one column per example.
+    :param k: The number of results per query.
+    :return: A tuple of the example indices and their scores, both of shape (queries, k), most similar first.
+    """
+    k = min(k, scores.shape[1])
+    # partially sorting every row, then ordering only the k best candidates
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1)
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1)
+
+
+class SearchBackend:
+    """
+    The interface every search backend implements: a top-k cosine similarity search over the example embeddings.
+    """
+
+    def search(self, queries, k):
+        """
+        This function finds the k most similar examples for every query.
+        :param queries: A matrix of query embeddings, one row per query.
+        :param k: The number of results per query.
+        :return: A tuple of the example indices and their scores, both of shape (queries, k), most similar first.
+        """
+        raise NotImplementedError
+
+
+class ExactSearch(SearchBackend):
+    """
+    Exact top-k search: all example embeddings are kept in one contiguous matrix, and a batch of queries is answered with
+    a single matrix product plus argpartition. The matrix can be stored as float32, float16 or int8 to save memory.
+    """
+
+    def __init__(self, vectors, precision="float32"):
+        vectors = normalize(vectors)
+        self.precision = precision
+        if precision == "float32":
+            self.matrix = vectors
+            self.scales = None
+        elif precision == "float16":
+            self.matrix = vectors.astype(np.float16)
+            self.scales = None
+        elif precision == "int8":
+            # symmetric per row quantization, every row keeps its own scale
+            self.scales = np.abs(vectors).max(axis=1) / 127.0
+            self.scales[self.scales == 0] = 1.0
+            self.matrix = np.round(vectors / self.scales[:, None]).astype(np.int8)
+            self.scales = self.scales.astype(np.float32)
+        else:
+            raise ValueError(f"Unsupported precision: {precision}")
+
+    def _scores(self, queries):
+        """
+        This function computes the similarity of every query with every example.
+        :param queries: A float32 matrix of normalized query embeddings.
+        :return: A float32 matrix of scores of shape (queries, examples).
+        """
+        if self.precision == "float32":
+            return queries @ self.matrix.T
+        # float16 and int8 have no fast matrix product, so the matrix is converted back to float32 in blocks
+        scores = np.empty((queries.shape[0], self.matrix.shape[0]), dtype=np.float32)
+        for start in range(0, self.matrix.shape[0], BLOCK_ROWS):
+            block = self.matrix[start:start + BLOCK_ROWS].astype(np.float32)
+            scores[:, start:start + BLOCK_ROWS] = queries @ block.T
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    def search(self, queries, k):
+        return _top_k(self._scores(normalize(queries)), k)
+
+
+class HnswSearch(SearchBackend):
+    """
+    Approximate top-k search with an HNSW graph (hnswlib, installed with chroma-hnswlib). Only worth it once the example
+    corpus grows to hundreds of thousands of prompts, for the 1200 sample prompts the exact search is faster.
+    """
+
+    def __init__(self, vectors, m=16, ef_construction=200, ef_search=64, threads=-1):
+        # hnswlib is only needed by this backend, so it is only imported when the backend is used
+        import hnswlib
+        vectors = normalize(vectors)
+        self.ef_search = ef_search
+        self.index = hnswlib.Index(space="ip", dim=vectors.shape[1])
+        self.index.init_index(max_elements=vectors.shape[0], ef_construction=ef_construction, M=m)
+        self.index.add_items(vectors, np.arange(vectors.shape[0]), num_threads=threads)
+
+    def search(self, queries, k):
+        # the search breadth has to be at least k, or hnswlib returns fewer results
+        self.index.set_ef(max(self.ef_search, k))
+        labels, distances = self.index.knn_query(normalize(queries), k=min(k, self.index.get_current_count()))
+        # the inner product distance is 1 - similarity
+        return labels.astype(np.int64), 1.0 - distances
+
+
+# the available search backends, selected by name
+BACKENDS = {
+    "exact": ExactSearch,
+    "hnsw": HnswSearch,
+}
+
+
+def create_backend(name, vectors, **kwargs):
+    """
+    This function creates a search backend over the example embeddings.
+    :param name: The name of the backend, "exact" or "hnsw".
+    :param vectors: The matrix of example embeddings, one row per example.
+    :param kwargs: Backend specific options, for example precision="int8" for the exact backend.
+    :return: The search backend.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown retrieval backend: {name}, choose one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](vectors, **kwargs)
+
+
+class ExampleRetriever:
+    """
+    An example selector for the FewShotPromptTemplate that searches the example embeddings with a pluggable search
+    backend. It returns the same example dictionaries (input, description and answer) as the sample prompts yaml file.
+    """
+
+    def __init__(self, examples, backend, embeddings, k=3):
+        self.examples = examples
+        self.backend = backend
+        self.embeddings = embeddings
+        self.k = k
+
+    def select_examples_by_vector(self, query_vector):
+        """
+        This function selects the k most similar examples for an already embedded question.
+        :param query_vector: The embedding of the users question.
+        :return: A list of the k most similar examples, most similar first.
+        """
+        return self.select_examples_batch(np.atleast_2d(query_vector))[0]
+
+    def select_examples_batch(self, query_vectors):
+        """
+        This function selects the k most similar examples for a batch of embedded questions at once.
+        :param query_vectors: A matrix of question embeddings, one row per question.
+        :return: A list with the list of the k most similar examples of every question.
+        """
+        with tracer.span("vector_search", queries=len(query_vectors), k=self.k):
+            indices, _ = self.backend.search(query_vectors, self.k)
+        return [self.examples_at(row) for row in indices]
+
+    def examples_at(self, indices):
+        """
+        :param indices: The positions of examples in the index.
+        :return: A list of copies of the examples at those positions.
+        """
+        return [dict(self.examples[i]) for i in indices]
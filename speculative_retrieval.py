@@ -0,0 +1,137 @@
+import logging
+import os
+import threading
+from dataclasses import dataclass
+import numpy as np
+from prompt_finder_and_invoke_llm import build_prompt, embed_question
+from resources import get_example_selector, get_index, get_pipeline
+from retrieval import HnswSearch, normalize
+
+logger = logging.getLogger(__name__)
+
+# the number of candidate examples kept for the latest partial transcript, the final question is re-scored against these
+CANDIDATE_POOL = int(os.getenv('speculative_candidate_pool', 32))
+# partial transcripts with fewer words are not embedded yet
+MIN_WORDS = int(os.getenv('speculative_min_words', 3))
+# how long finalize() waits for a speculation of the final question that is still running, in seconds
+FINALIZE_WAIT = 1.0
+
+
+@dataclass
+class Speculation:
+    """
+    The retrieval for a transcript: its embedding, the candidate pool of examples, the selected examples and the
+    assembled few-shot prompt.
+    """
+    text: str
+    vector: list
+    candidates: np.ndarray
+    examples: list
+    prompt: str
+    # "speculative" if the final question was already retrieved while the user was speaking, "rescored" if the candidate
+    # pool was re-scored (hnsw backend only), and "full" if the final question was searched in the whole index
+    source: str = "speculative"
+
+
+class SpeculativeRetriever:
+    """
+    Keeps the retrieval of a question up to date while the user is still speaking. Every partial or finalized transcript
+    is embedded in the background on the embedding stage, and the candidate examples and the few-shot prompt are kept
+    for the latest one. When the question ends, the work is reused if the final transcript was already seen. Otherwise
+    the final question is embedded and searched like without speculation, an exact search over the whole index takes
+    microseconds. Only with the approximate hnsw backend is the candidate pool of the last partial transcript re-scored
+    instead.
+    """
+
+    def __init__(self, memory=None, pool_size=CANDIDATE_POOL, min_words=MIN_WORDS):
+        self.memory = memory
+        self.pool_size = pool_size
+        self.min_words = min_words
+        self.condition = threading.Condition()
+        self.latest = None
+        self.running = False
+        self.finalized = False
+        self.speculation = None
+        # the number of transcripts that were embedded while the user was speaking
+        self.speculations = 0
+
+    def update(self, text):
+        """
+        This function hands the transcript so far to the retriever. It never blocks, so it can be called from the event
+        loop of the transcription: only the latest transcript is retrieved, and nothing is done if the embedding stage
+        is busy.
+        :param text: The transcript so far, including the words that are not final yet.
+        """
+        if len(text.split()) < self.min_words:
+            return
+        with self.condition:
+            if self.finalized:
+                return
+            self.latest = text
+            if self.running:
+                return
+            self.running = True
+        if get_pipeline().stages["embedding"].try_submit(self._speculate) is None:
+            with self.condition:
+                self.running = False
+
+    def _speculate(self):
+        # retrieving the latest transcript until it no longer changes
+        failed = None
+        while True:
+            with self.condition:
+                text = self.latest
+                if self.finalized or text == failed or (self.speculation is not None and self.speculation.text == text):
+                    self.running = False
+                    self.condition.notify_all()
+                    return
+            try:
+                speculation = self._retrieve(text)
+            except Exception:
+                # the next transcript is still tried, the final question falls back to a full retrieval if needed
+                logger.exception("Speculative retrieval failed")
+                failed = text
+                continue
+            with self.condition:
+                self.speculation = speculation
+                self.speculations += 1
+                self.condition.notify_all()
+
+    def _retrieve(self, text):
+        vector = embed_question(text)
+        selector = get_example_selector()
+        candidates = selector.backend.search(np.atleast_2d(vector), max(self.pool_size, selector.k))[0][0]
+        examples = selector.examples_at(candidates[:selector.k])
+        return Speculation(text, vector, candidates, examples, build_prompt(text, self.memory, vector, examples))
+
+    def finalize(self, question):
+        """
+        This function completes the retrieval once the question is final.
+        :param question: The finalized transcript of the question.
+        :return: The Speculation of the final question, with its embedding, examples and prompt.
+        """
+        text = question.strip()
+        with self.condition:
+            # waiting for a speculation of exactly this transcript that is still running, instead of repeating it
+            self.condition.wait_for(lambda: not self.running or self.latest != text or
+                                    (self.speculation is not None and self.speculation.text == text),
+                                    timeout=FINALIZE_WAIT)
+            self.finalized = True
+            speculation = self.speculation
+        if speculation is not None and speculation.text == text:
+            logger.info("Speculative retrieval reused for the final question (%d speculations)", self.speculations)
+            return speculation
+        vector = get_pipeline().run("embedding", embed_question, text)
+        selector = get_example_selector()
+        if speculation is None or not isinstance(selector.backend, HnswSearch):
+            # the same examples as without speculative retrieval
+            examples = selector.select_examples_by_vector(vector)
+            return Speculation(text, vector, None, examples, build_prompt(text, self.memory, vector, examples), "full")
+        # the candidates of the latest partial transcript are re-scored against the final question, exactly, instead of
+        # another approximate search of the graph
+        scores = normalize(get_index().vectors[speculation.candidates]) @ normalize(vector)[0]
+        order = np.argsort(-scores)[:selector.k]
+        examples = selector.examples_at(speculation.candidates[order])
+        logger.info("Speculative retrieval re-scored %d candidates for the final question", len(order))
+        return Speculation(text, vector, speculation.candidates, examples,
+                           build_prompt(text, self.memory, vector, examples), "rescored")
@@ -0,0 +1,92 @@
+"""
+Startup profile of the app. The modules of the app are imported in a fresh interpreter with python -X importtime, and the
+import time of every app module and of the heaviest third party packages is reported, followed by the time it takes to
+load every shared resource.
+
+    python startup_profile.py [--top 15] [--skip-warm-up]
+
+Run it after changing imports, a module that imports langchain, torch or yaml at the top costs seconds on every start.
+"""
+import argparse
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+# the modules the streamlit app imports, directly or through each other
+APP_MODULES = ("resources", "prompt_finder_and_invoke_llm", "speculative_retrieval", "text_to_speech",
+               "live_transcription", "answer_cache", "retrieval", "example_index", "pipeline", "tracing")
+# a line of the -X importtime output: "import time: self [us] | cumulative | imported package"
+IMPORT_TIME = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def import_times(modules=APP_MODULES):
+    """
+    This function imports modules in a fresh interpreter and collects the import time of every module it loaded.
+    :param modules: The names of the modules to import.
+    :return: A list of (module name, nesting depth, self milliseconds, cumulative milliseconds) tuples, in import order.
+    """
+    code = "; ".join(f"import {module}" for module in modules)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing the app failed:\n{result.stderr}")
+    times = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            # the module names are indented by two spaces per level of nesting
+            times.append((name, (len(indent) - 1) // 2, int(self_us) / 1000, int(cumulative_us) / 1000))
+    return times
+
+
+def report_imports(times, top=15):
+    """
+    This function prints the cumulative import time of every app module and of the heaviest top level packages.
+    :param times: The import times returned by import_times().
+    :param top: The number of packages to print.
+    """
+    print("App modules (cumulative import time):")
+    for name, _, _, cumulative_ms in times:
+        if name in APP_MODULES:
+            print(f"  {name:<32} {cumulative_ms:9.1f} ms")
+    # adding up the self time of every module per top level package, so a package is counted once no matter who imports
+    # it first
+    packages = defaultdict(float)
+    for name, _, self_ms, _ in times:
+        packages[name.split(".")[0]] += self_ms
+    print(f"\nHeaviest packages (self import time of all their modules), top {top}:")
+    for package, self_ms in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {package:<32} {self_ms:9.1f} ms")
+    total_ms = sum(self_ms for self_ms in packages.values())
+    print(f"\nTotal import time: {total_ms:.1f} ms")
+
+
+def report_warm_up():
+    """
+    This function loads every shared resource of the app, like streamlit does on startup, and prints the load times.
+    """
+    import resources
+    for name, error in resources.warm().items():
+        print(f"Failed to load {name}: {error}")
+    timings = resources.timings()
+    print("\nResource load times:")
+    for name, seconds in timings["load_seconds"].items():
+        print(f"  {name:<32} {seconds * 1000:9.1f} ms")
+    if timings["warm_up_seconds"] is not None:
+        print(f"\nWarm up: {timings['warm_up_seconds']:.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the import and warm up time of the app.")
+    parser.add_argument("--top", type=int, default=15, help="the number of packages to report")
+    parser.add_argument("--skip-warm-up", action="store_true", help="only profile the imports")
+    args = parser.parse_args()
+    report_imports(import_times(), args.top)
+    if not args.skip_warm_up:
+        report_warm_up()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
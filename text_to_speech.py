@@ -0,0 +1,301 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from resources import get_pipeline, get_polly
+from tracing import tracer
+
+# the voice and engine Amazon Polly uses to read the answers out loud
+VOICE_ID = "Danielle"
+ENGINE = "neural"
+OUTPUT_FORMAT = "mp3"
+# the directory synthesized audio is cached in, so the same sentence is never sent to Polly twice
+AUDIO_CACHE_DIR = os.getenv('tts_cache_dir', 'tts_cache')
+# the maximum size of the audio cache on disk, the least recently used audio is removed once it is exceeded
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('tts_cache_max_bytes', 512 * 1024 * 1024))
+# Polly returns neural mp3 audio at 24 kHz and 48 kbps, which is used to estimate how long a segment plays
+MP3_BITRATE = 48000
+# added to the estimated duration of a segment before the next one replaces it, for the time the browser takes to start
+# playing, so the end of a sentence is not cut off
+PLAYBACK_MARGIN = float(os.getenv('tts_playback_margin_seconds', 0.5))
+# a sentence ends with punctuation followed by whitespace, or with a line break
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+class AudioCache:
+    """
+    A content-addressed disk cache of synthesized audio, keyed by a hash of the text, voice, engine and output format.
+    The modification time of a file is its last use, so the least recently used audio is removed first once the cache
+    grows beyond max_bytes.
+    """
+
+    def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # the size of the cache on disk, counted on the first put and kept up to date by this process
+        self.size = None
+
+    @staticmethod
+    def key(text, voice, engine, output_format):
+        return hashlib.sha256("\0".join((text, voice, engine, output_format)).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        :return: The cached audio for the key, or None if it was never synthesized.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as audio_file:
+                audio = audio_file.read()
+            # marking the audio as recently used
+            os.utime(path)
+            return audio
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, audio):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # writing to a temporary file first, so a reader never sees half an mp3
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as audio_file:
+            audio_file.write(audio)
+        os.replace(temporary_path, path)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._files())
+            else:
+                self.size += len(audio)
+            if self.size > self.max_bytes:
+                self._prune()
+
+    def _files(self):
+        """
+        :return: A list of (modification time, size, path) tuples of every cached audio file.
+        """
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # removed by another process in the meantime
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _prune(self):
+        # the sizes are counted again, other processes may share the directory
+        files = sorted(self._files())
+        self.size = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+audio_cache = AudioCache()
+# the requests that are in flight, so the same text requested twice at the same time is only synthesized once
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def _synthesize_uncached(text, voice, engine, output_format):
+    with tracer.span("polly", characters=len(text)) as span:
+        response = get_polly().synthesize_speech(Text=text, OutputFormat=output_format, VoiceId=voice, Engine=engine)
+        audio = response['AudioStream'].read()
+        span.set(audio_bytes=len(audio))
+    return audio
+
+
+def synthesize(text, voice=VOICE_ID, engine=ENGINE, output_format=OUTPUT_FORMAT):
+    """
+    This function converts text to natural sounding speech with Amazon Polly, unless the same text was synthesized
+    before with the same voice, engine and format, in which case the audio comes from the disk cache.
+    :param text: The text to read out loud.
+    :param voice: The Polly voice.
+    :param engine: The Polly engine.
+    :param output_format: The audio format.
+    :return: The audio as bytes.
+    """
+    key = AudioCache.key(text, voice, engine, output_format)
+    audio = audio_cache.get(key)
+    if audio is not None:
+        return audio
+    with _in_flight_lock:
+        event = _in_flight.get(key)
+        owner = event is None
+        if owner:
+            event = _in_flight[key] = threading.Event()
+    if not owner:
+        # another thread is synthesizing the same text, waiting for its result instead of calling Polly again
+        event.wait()
+        audio = audio_cache.get(key)
+        if audio is not None:
+            return audio
+        return _synthesize_uncached(text, voice, engine, output_format)
+    try:
+        audio = _synthesize_uncached(text, voice, engine, output_format)
+        audio_cache.put(key, audio)
+        return audio
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+        event.set()
+
+
+def split_sentences(text, min_chars=20):
+    """
+    This function splits a complete answer into sentences, so they can be synthesized in parallel.
+    :param text: The answer.
+    :param min_chars: Sentences shorter than this are merged with the next one.
+    :return: A list of the sentences.
+    """
+    splitter = SentenceSplitter(min_chars)
+    return splitter.feed(text) + splitter.flush()
+
+
+def synthesize_stream(text):
+    """
+    This function synthesizes a long answer sentence by sentence, with the sentences sent to Polly in parallel on the
+    bounded tts stage of the request pipeline (tts_workers). The mp3 segments are yielded in order, as soon as each one is ready.
+    :param text: The answer to read out loud.
+    :return: A generator of the mp3 segments of the answer.
+    """
+    futures = [get_pipeline().submit("tts", synthesize, sentence) for sentence in split_sentences(text)]
+    for future in futures:
+        yield future.result()
+
+
+def synthesize_answer(text):
+    """
+    This function synthesizes a whole answer, joining the mp3 segments of its sentences.
+    :param text: The answer to read out loud.
+    :return: The mp3 audio as bytes.
+    """
+    return b"".join(synthesize_stream(text))
+
+
+def estimate_mp3_seconds(audio):
+    """
+    This function estimates how long an mp3 segment returned by Polly plays.
+    :param audio: The mp3 audio as bytes.
+    :return: The estimated duration in seconds.
+    """
+    return len(audio) * 8 / MP3_BITRATE
+
+
+class SentenceSplitter:
+    """
+    Collects the streamed tokens of an answer and hands back every sentence as soon as it is complete, so it can be sent
+    to Polly while the rest of the answer is still being generated.
+    """
+
+    def __init__(self, min_chars=20):
+        # very short sentences are merged with the next one, so Polly is not called for fragments like "1."
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, token):
+        """
+        This function adds a streamed token to the buffer.
+        :param token: The next piece of text of the answer.
+        :return: A list of the sentences that were completed by this token.
+        """
+        self.buffer += token
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self.buffer):
+            sentence = self.buffer[start:match.start()].strip()
+            if len(sentence) >= self.min_chars:
+                sentences.append(sentence)
+                start = match.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self):
+        """
+        This function returns whatever is left in the buffer once the answer is complete.
+        :return: A list with the last sentence, or an empty list if nothing is left.
+        """
+        sentence = self.buffer.strip()
+        self.buffer = ""
+        return [sentence] if sentence else []
+
+
+class SpeechQueue:
+    """
+    Synthesizes sentences in the background and plays the audio segments in order. While the answer is streamed, a
+    segment is only played once the previous one has finished, based on its estimated duration plus a safety margin.
+    Once the answer is complete, all remaining segments are handed to the browser as one mp3, which plays them in order
+    without the server timing them.
+    """
+
+    def __init__(self, play, margin=PLAYBACK_MARGIN):
+        # play is called with the mp3 bytes of every segment, for example the audio method of a streamlit placeholder
+        self.play = play
+        self.margin = margin
+        self.pending = []
+        # the synthesized segments that were not played yet, once the answer is complete
+        self.unplayed = []
+        self.segments = []
+        self.playing_until = 0.0
+        # the time the first segment started playing, used to report the time-to-first-audio
+        self.first_audio_time = None
+
+    def add(self, sentence):
+        """
+        This function sends a sentence to Polly without waiting for the audio.
+        :param sentence: The sentence to read out loud.
+        """
+        self.pending.append(get_pipeline().submit("tts", synthesize, sentence))
+
+    def _play(self, audio):
+        now = time.perf_counter()
+        if self.first_audio_time is None:
+            self.first_audio_time = now
+        self.play(audio)
+        self.playing_until = now + estimate_mp3_seconds(audio) + self.margin
+
+    def play_ready(self):
+        """
+        This function plays the next segment if its audio is ready and the previous segment has finished, without
+        blocking.
+        """
+        if self.pending and self.pending[0].done() and time.perf_counter() >= self.playing_until:
+            audio = self.pending.pop(0).result()
+            self.segments.append(audio)
+            self._play(audio)
+
+    def finish(self):
+        """
+        This function waits until every sentence is synthesized, without playing anything.
+        :return: The mp3 audio of the whole answer, as bytes.
+        """
+        while self.pending:
+            self.unplayed.append(self.pending.pop(0).result())
+        return b"".join(self.segments + self.unplayed)
+
+    def drain(self):
+        """
+        This function plays all remaining segments. It only waits for the segment that is playing right now to finish,
+        then hands the rest to the browser as one mp3.
+        """
+        self.finish()
+        if not self.unplayed:
+            return
+        time.sleep(max(0.0, self.playing_until - time.perf_counter()))
+        audio = b"".join(self.unplayed)
+        self.segments.extend(self.unplayed)
+        self.unplayed = []
+        self._play(audio)
@@ -0,0 +1,254 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque, OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import numpy as np
+from dotenv import load_dotenv
+
+# loading in environment variables
+load_dotenv()
+
+# the name the spans are exported under
+SERVICE_NAME = "genai-millionaire"
+# every finished span is appended to this JSONL file, if it is set
+TRACE_JSONL = os.getenv('trace_jsonl')
+# every finished trace is appended to this file in the OpenTelemetry OTLP/JSON format, if it is set
+TRACE_OTLP = os.getenv('trace_otlp')
+# the number of most recent spans per stage the percentiles are computed over
+TRACE_WINDOW = int(os.getenv('trace_window', 1000))
+# a trace whose root span has not ended after this many seconds is written with the spans it has so far
+TRACE_PENDING_SECONDS = float(os.getenv('trace_pending_seconds', 300))
+# the maximum number of unfinished traces held in memory, the oldest one is written when there are more
+TRACE_MAX_PENDING = int(os.getenv('trace_max_pending', 1000))
+
+# the span that is currently open in this thread or task, new spans become its children
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+@dataclass
+class Span:
+    """
+    The timing of one stage of a turn, with attributes like token counts and byte sizes.
+    """
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str = None
+    start_time_ns: int = field(default_factory=time.time_ns)
+    duration_ns: int = None
+    attributes: dict = field(default_factory=dict)
+
+    def set(self, **attributes):
+        """
+        This function adds attributes to the span.
+        """
+        self.attributes.update(attributes)
+
+    @property
+    def seconds(self):
+        return self.duration_ns / 1e9 if self.duration_ns is not None else None
+
+    def to_dict(self):
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+                "start_time_ns": self.start_time_ns, "duration_ms": self.duration_ns / 1e6,
+                "attributes": self.attributes}
+
+
+def _otlp_value(value):
+    # the attribute value in the OTLP/JSON encoding, 64 bit integers are encoded as strings
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans):
+    """
+    This function converts finished spans to the OTLP/JSON format, as read by the file receiver of the OpenTelemetry
+    collector.
+    :param spans: A list of finished spans.
+    :return: A dictionary with the resourceSpans of the spans.
+    """
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{
+            "scope": {"name": SERVICE_NAME},
+            "spans": [{
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                "parentSpanId": span.parent_id or "",
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_time_ns),
+                "endTimeUnixNano": str(span.start_time_ns + span.duration_ns),
+                "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+            } for span in spans],
+        }],
+    }]}
+
+
+class JsonlExporter:
+    """
+    Appends every finished span to a JSONL file, one span per line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock, open(self.path, "a") as trace_file:
+            trace_file.write(line + "\n")
+
+
+class OtlpJsonExporter:
+    """
+    Collects the spans of a trace and appends them to a file in the OTLP/JSON format once the root span is finished, one
+    export request per line. Spans that end after their root span, like a speculative embedding that outlived the turn,
+    are written on their own. A trace whose root span never ends is written once it is older than `max_age` seconds, or
+    when more than `max_pending` traces are unfinished.
+    """
+
+    def __init__(self, path, max_age=TRACE_PENDING_SECONDS, max_pending=TRACE_MAX_PENDING):
+        self.path = path
+        self.max_age = max_age
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        # the spans of every unfinished trace and the time its first span arrived, oldest trace first
+        self.pending = OrderedDict()
+        # the traces that were already written, so late spans are written right away instead of being held
+        self.written = OrderedDict()
+
+    def export(self, span):
+        with self.lock:
+            if span.trace_id in self.written:
+                self._write(span.trace_id, [span])
+            else:
+                self.pending.setdefault(span.trace_id, (time.monotonic(), []))[1].append(span)
+                if span.parent_id is None:
+                    self._write(span.trace_id, self.pending.pop(span.trace_id)[1])
+            # writing the traces that waited too long for their root span
+            now = time.monotonic()
+            while self.pending and (len(self.pending) > self.max_pending or
+                                    now - next(iter(self.pending.values()))[0] > self.max_age):
+                trace_id, (_, spans) = self.pending.popitem(last=False)
+                self._write(trace_id, spans)
+
+    def _write(self, trace_id, spans):
+        self.written[trace_id] = True
+        while len(self.written) > self.max_pending:
+            self.written.popitem(last=False)
+        with open(self.path, "a") as trace_file:
+            trace_file.write(json.dumps(to_otlp(spans)) + "\n")
+
+
+class Tracer:
+    """
+    Records a span for every stage of a turn. The spans of a turn share a trace id, and a span opened while another one
+    is open becomes its child, also in the worker threads of the request pipeline. Finished spans are handed to the
+    exporters, and the durations of the most recent spans are kept per stage for the percentiles.
+    """
+
+    def __init__(self, exporters=(), window=TRACE_WINDOW):
+        self.exporters = list(exporters)
+        self.window = window
+        self.durations = defaultdict(lambda: deque(maxlen=self.window))
+        self.lock = threading.Lock()
+
+    def start_span(self, name, **attributes):
+        """
+        This function opens a span and makes it the current span, until end_span() is called.
+        :param name: The name of the stage.
+        :return: The open Span.
+        """
+        parent = _current_span.get()
+        span = Span(name, parent.trace_id if parent else os.urandom(16).hex(), os.urandom(8).hex(),
+                    parent.span_id if parent else None, attributes=attributes)
+        span._start = time.perf_counter_ns()
+        span._token = _current_span.set(span)
+        return span
+
+    def end_span(self, span):
+        """
+        This function closes a span that was opened with start_span() and exports it.
+        :param span: The open Span.
+        """
+        span.duration_ns = time.perf_counter_ns() - span._start
+        try:
+            _current_span.reset(span._token)
+        except ValueError:
+            # the span was ended in another context than it was started in
+            pass
+        self._finish(span)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        This function records a span for the duration of the with block.
+        :param name: The name of the stage.
+        :return: The open Span, so attributes can be added to it.
+        """
+        span = self.start_span(name, **attributes)
+        try:
+            yield span
+        except GeneratorExit:
+            # a streamed stage whose consumer stopped early
+            span.set(cancelled=True)
+            raise
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            self.end_span(span)
+
+    def record(self, name, start, end=None, **attributes):
+        """
+        This function records a span for a stage that was timed elsewhere, as a child of the current span.
+        :param name: The name of the stage.
+        :param start: The time.perf_counter() value the stage started at.
+        :param end: The time.perf_counter() value the stage ended at, now by default.
+        """
+        end = time.perf_counter() if end is None else end
+        parent = _current_span.get()
+        # converting the performance counter to the wall clock time the exporters use
+        start_time_ns = time.time_ns() - int((time.perf_counter() - start) * 1e9)
+        span = Span(name, parent.trace_id if parent else os.urandom(16).hex(), os.urandom(8).hex(),
+                    parent.span_id if parent else None, start_time_ns, int((end - start) * 1e9), attributes)
+        self._finish(span)
+
+    def _finish(self, span):
+        with self.lock:
+            self.durations[span.name].append(span.seconds)
+        for exporter in self.exporters:
+            exporter.export(span)
+
+    def percentiles(self):
+        """
+        :return: A dictionary of stage name to the count, p50 and p95 of its most recent durations, in seconds.
+        """
+        with self.lock:
+            durations = {name: list(values) for name, values in self.durations.items()}
+        return {name: {"count": len(values), "p50": float(np.percentile(values, 50)),
+                       "p95": float(np.percentile(values, 95))}
+                for name, values in sorted(durations.items())}
+
+
+def _exporters():
+    exporters = []
+    if TRACE_JSONL:
+        exporters.append(JsonlExporter(TRACE_JSONL))
+    if TRACE_OTLP:
+        exporters.append(OtlpJsonExporter(TRACE_OTLP))
+    return exporters
+
+
+# the process-wide tracer, every module records its spans here
+tracer = Tracer(_exporters())